@@ -0,0 +1,207 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject, CallbackQuery, ReplyKeyboardRemove
+
+#==============================================================================#
+# Допуск тяжелых запросов. Хэндлеры помечаются флагом `cost` - классом стоимости
+# (или функцией, которая определяет класс по событию). Для каждого пользователя
+# действуют лимит одновременных запросов и "ведро токенов", а общие слоты под тяжелую
+# работу раздаются по кругу между пользователями, так что один активный пользователь
+# не занимает CPU за всех.
+
+# класс стоимости -> сколько токенов списывается из ведра пользователя
+COSTS = {'search': 2, 'caption': 1, 'vqa': 2, 'similar': 1}
+
+RATE_REPLY = '🚦 Слишком много запросов, подожди {} сек.'
+BUSY_USER_REPLY = '⏳ Дождись результата предыдущего запроса'
+QUEUE_REPLY = '⏳ Ты в очереди: {}'
+
+#==============================================================================#
+
+class TokenBucket:
+    """Ведро токенов: `burst` токенов, пополняется на `rate` токенов в секунду."""
+
+    def __init__(self, burst: float, rate: float):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount: float) -> float:
+        """Списывает токены; возвращает 0 или сколько секунд ждать, если токенов не хватает."""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+#==============================================================================#
+
+class FairScheduler:
+    """Раздает `slots` слотов тяжелой работы по кругу между пользователями (round-robin)."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self._queues: dict[int, deque[asyncio.Future]] = {}
+        self._ring: deque[int] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def position(self, user_id: int) -> int:
+        """Номер последнего запроса пользователя в очереди при раздаче слотов по кругу."""
+        left = {uid: len(self._queues[uid]) for uid in self._ring}
+        if not left.get(user_id, 0):
+            return 0
+        pos = 0
+        while True:
+            for uid in self._ring:
+                if not left[uid]: continue
+                left[uid] -= 1
+                pos += 1
+                if uid == user_id and not left[uid]:
+                    return pos
+
+    async def acquire(self, user_id: int, notify: Optional[Callable[[int], Awaitable]] = None):
+        if self.active < self.slots and not self._ring:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        if not user_id in self._queues:
+            self._queues[user_id] = deque()
+            self._ring.append(user_id)
+        self._queues[user_id].append(future)
+        try:
+            if notify:
+                try:
+                    await notify(self.position(user_id))
+                except Exception as err:
+                    logging.exception(err, exc_info=False)
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # слот уже выдан, но ждать его некому - передаем следующему
+                self.release()
+            else:
+                self._remove(user_id, future)
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._ring and self.active < self.slots:
+            uid = self._ring.popleft()
+            queue = self._queues[uid]
+            future = queue.popleft()
+            if queue:
+                self._ring.append(uid)
+            else:
+                del self._queues[uid]
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def _remove(self, user_id: int, future: asyncio.Future):
+        queue = self._queues.get(user_id, None)
+        if queue is None or not future in queue:
+            return
+        queue.remove(future)
+        if not queue:
+            del self._queues[user_id]
+            self._ring.remove(user_id)
+
+#==============================================================================#
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Внутренний middleware для `dp.message` и `dp.callback_query`: применяется только к хэндлерам с флагом `cost`.
+    С `schedule=False` (тяжелую работу делают удаленные воркеры) действуют только лимиты пользователя."""
+
+    def __init__(self, slots: int, user_concurrency: int, burst: float, per_minute: float, schedule: bool = True):
+        self.user_concurrency = user_concurrency
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.schedule = schedule
+        self.scheduler = FairScheduler(slots)
+        self._buckets: dict[int, TokenBucket] = {}
+        self._running: dict[int, int] = {}
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        # полные ведра ничем не отличаются от новых - выбрасываем, чтобы словарь не рос
+        for uid in [uid for uid, b in self._buckets.items() if uid != user_id and b.full]:
+            del self._buckets[uid]
+        if not user_id in self._buckets:
+            self._buckets[user_id] = TokenBucket(self.burst, self.rate)
+        return self._buckets[user_id]
+
+    @staticmethod
+    async def _reply(event: TelegramObject, text: str):
+        msg = event.message if isinstance(event, CallbackQuery) else event
+        await msg.answer(text, reply_markup=ReplyKeyboardRemove())
+        if isinstance(event, CallbackQuery):
+            await event.answer()
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        cost = get_flag(data, 'cost')
+        if callable(cost):
+            cost = cost(event)
+        user = data.get('event_from_user', None)
+        if not cost or user is None:
+            return await handler(event, data)
+
+        if self._running.get(user.id, 0) >= self.user_concurrency:
+            await self._reply(event, BUSY_USER_REPLY)
+            return
+        wait = self._bucket(user.id).take(COSTS.get(cost, 1))
+        if wait:
+            logging.info(f'Admission: Лимит запросов для {user.id} ({cost})')
+            await self._reply(event, RATE_REPLY.format(int(wait) + 1))
+            return
+
+        self._running[user.id] = self._running.get(user.id, 0) + 1
+        try:
+            if not self.schedule:
+                return await handler(event, data)
+            msg = event.message if isinstance(event, CallbackQuery) else event
+            # в режиме вебхука ожидание в очереди не должно занимать слот обработки обновлений (webhook.UpdatePermit)
+            permit = data.get('update_permit', None)
+            if not permit is None:
+                permit.release()
+            await self.scheduler.acquire(user.id, lambda pos: msg.answer(QUEUE_REPLY.format(pos)))
+            try:
+                return await handler(event, data)
+            finally:
+                self.scheduler.release()
+        finally:
+            self._running[user.id] -= 1
+            if not self._running[user.id]:
+                del self._running[user.id]
+
+#==============================================================================#
+
+def search_cost(event: TelegramObject) -> Optional[str]:
+    text = event.data if isinstance(event, CallbackQuery) else event.text
+    return 'search' if text and text.strip().isdigit() and int(text) > 0 else None
+
+def action_cost(event: CallbackQuery) -> Optional[str]:
+    if event.data.endswith('писание'):
+        return 'caption'
+    if event.data.endswith('охожие'):
+        return 'similar'
+    return None
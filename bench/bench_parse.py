@@ -0,0 +1,76 @@
+"""Сравнение парсеров страницы выдачи Яндекса (lxml XPath и прежний BeautifulSoup)
+на сохраненных страницах из `bench/fixtures/*.html`.
+
+    python bench/bench_parse.py [-n 50]
+"""
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fakes import setup_env
+
+setup_env()
+
+from imgsimilar import Imgsimilar, SimilarResult
+
+# ============================================================ #
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+# ============================================================ #
+
+def parse_result_soup(imsim: Imgsimilar, html: str) -> SimilarResult:
+    """Прежний парсер бота на BeautifulSoup (до перехода на lxml XPath)."""
+    soup = BeautifulSoup(html, 'lxml')
+
+    url = soup.find('img', class_='CbirPreview-Image')
+    if url: 
+        url = url.get('src')
+
+    title = soup.find('h2', class_='CbirObjectResponse-Title')
+    subtitle = soup.find('div', class_='CbirObjectResponse-Description')
+
+    tags_div = soup.find('div', class_='Tags Tags_type_expandable Tags_view_buttons')
+    tags = []
+    if tags_div:
+        tags = [t.text for t in tags_div.find_all('span', class_='Button2-Text')]
+
+    thumbs_div = soup.find('div', class_='CbirSimilar-Thumbs')
+    styles = []
+    if thumbs_div:            
+        styles = [s.get('style') for s in thumbs_div.find_all('div', class_='MMImage MMImage_type_cover Thumb-Image')]
+    return imsim._make_result(url, title.text if title else None, subtitle.text if subtitle else None, tags, styles, None)
+
+def measure(fn, html: str, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(html)
+        timings.append(time.perf_counter() - t)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    imsim = Imgsimilar()
+    parse_soup = lambda html: parse_result_soup(imsim, html)
+    for page in sorted(FIXTURES.glob('*.html')):
+        html = page.read_text(encoding='utf-8')
+        fast, slow = imsim._parse_result(html), parse_soup(html)
+        if fast != slow:
+            print(f'{page.name}: результаты парсеров РАЗЛИЧАЮТСЯ{chr(10)}{fast!r}{chr(10)}{slow!r}')
+        t_fast = statistics.median(measure(imsim._parse_result, html, args.repeat))
+        t_slow = statistics.median(measure(parse_soup, html, args.repeat))
+        print(f'{page.name} ({len(html) // 1024} KB): lxml {t_fast * 1000:.2f} мс, '
+              f'BeautifulSoup {t_slow * 1000:.2f} мс, x{t_slow / t_fast:.1f}')
+
+if __name__ == '__main__':
+    main()
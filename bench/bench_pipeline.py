@@ -0,0 +1,296 @@
+"""Офлайн-бенчмарк конвейера бота: модули и хэндлеры `botmain` работают против локальных заглушек
+(bench/fakes.py) вместо Google, Яндекса, Google Drive и Telegram. Для каждого сценария считаются
+пропускная способность, задержки p50/p95/p99 и пиковый RSS; результаты сохраняются в JSON.
+
+    python bench/bench_pipeline.py [сценарии ...] [-n 20] [-c 20] [--latency 0.05] [--compare bench/results/old.json]
+
+Сценарии: search, similar, translate, gdrive, bot_search, bot_caption.
+Сценарии bot_* импортируют `botmain` (нужны aiogram и LAVIS), bot_caption еще и грузит модели BLIP.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import statistics
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fakes import FakeServices, make_image, setup_env
+
+setup_env()
+
+from config import CONFIG
+
+# логи бота на каждый запрос исказили бы замеры
+logging.getLogger().setLevel(logging.WARNING)
+
+# ============================================================ #
+
+RESULTS = Path(__file__).resolve().parent / 'results'
+# сценарий -> (запросов, одновременно, описание)
+SCENARIOS = {
+    'search': (20, 20, 'параллельные поиски картинок (imgsearch.search)'),
+    'similar': (50, 10, 'поиск похожих (Imgsimilar.upload_and_parse)'),
+    'translate': (200, 100, 'переводы (Translator.translate)'),
+    'gdrive': (50, 10, 'загрузка в Google Drive (Gdrive.upload)'),
+    'bot_search': (20, 20, 'поиск картинок через хэндлеры botmain'),
+    'bot_caption': (100, 100, 'описания картинок через хэндлеры botmain'),
+}
+DEFAULT_SCENARIOS = ['search', 'similar', 'translate', 'gdrive']
+
+# ============================================================ #
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def reset_peak_rss():
+    # Linux: запись "5" в clear_refs сбрасывает VmHWM, так что пик считается по каждому сценарию отдельно
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        pass
+
+def peak_rss_mb() -> float:
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+async def run_load(name: str, requests: int, concurrency: int, make_call: Callable[[int], Awaitable]) -> dict:
+    """Выполняет `requests` вызовов `make_call(i)`, не более `concurrency` одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            t = time.perf_counter()
+            try:
+                await make_call(i)
+            except Exception as err:
+                errors += 1
+                print(f'  [{name}] #{i}: {type(err).__name__}: {err}')
+                return
+            latencies.append(time.perf_counter() - t)
+
+    reset_peak_rss()
+    t = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    total = time.perf_counter() - t
+    ms = [x * 1000 for x in latencies] or [0.0]
+    return {'name': name, 'requests': requests, 'concurrency': concurrency, 'errors': errors,
+            'total_s': round(total, 3), 'throughput_rps': round(len(latencies) / total, 2) if total else 0.0,
+            'latency_ms': {'p50': round(percentile(ms, 50), 1), 'p95': round(percentile(ms, 95), 1),
+                           'p99': round(percentile(ms, 99), 1), 'mean': round(statistics.fmean(ms), 1),
+                           'max': round(max(ms), 1)},
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+# ============================================================ #
+# сценарии: получают заглушки и аргументы, возвращают функцию одного запроса
+
+def setup_search(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    import imgsearch
+    imgsearch.SEARCH_URL = f'{fakes.base}/customsearch/v1'
+
+    async def call(i: int):
+        # разные запросы, чтобы не попадать в кэш выдачи (если не просили обратного)
+        found = await imgsearch.search(q='bench' if args.warm else f'bench {i}', num=args.images)
+        if len(found) < args.images:
+            raise RuntimeError(f'найдено {len(found)} из {args.images}')
+    return call
+
+def patch_drive(fakes: FakeServices, args):
+    """PyDrive ходит в API Google через свой клиент: заменяем блокирующие вызовы имитацией с той же задержкой,
+    они по-прежнему выполняются в однопоточном исполнителе Gdrive."""
+    import gdrive
+    import imgsimilar
+
+    def _upload(self, fname: str, mime: str, content: bytes, replace_id: Optional[str]) -> gdrive.Gfile:
+        time.sleep(args.drive_latency)
+        file_id = gdrive.Gdrive.generate_uid()
+        return gdrive.Gfile(title=fname, mime=mime, id=file_id, url=f'{fakes.base}/img/{random.randrange(1000)}.jpg')
+
+    def _delete(self, file_id: str, permanent: bool = True):
+        time.sleep(args.drive_latency)
+
+    gdrive.Gdrive._upload = _upload
+    gdrive.Gdrive._delete = _delete
+    gdrive.Gdrive._list_orphans = lambda self: []
+    return imgsimilar.DRIVE
+
+def setup_similar(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    import imgsimilar
+    imgsimilar.BASE_URL = f'{fakes.base}/images/search'
+    CONFIG.similar_upload = args.similar_upload
+    patch_drive(fakes, args)
+    images = [make_image(1000 + i, (800, 600)) for i in range(requests)]
+
+    async def call(i: int):
+        res = await imgsimilar.Imgsimilar().upload_and_parse(images[0 if args.warm else i])
+        if not res.similar:
+            raise RuntimeError('пустой результат')
+    return call
+
+def setup_translate(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    import translator
+    translator.BASE_URL = f'{fakes.base}/translate/v2'
+
+    async def call(i: int):
+        res = await translator.Translator().translate(f'a yellow excavator number {0 if args.warm else i}', 'ru', 'en')
+        if not res:
+            raise RuntimeError('нет перевода')
+    return call
+
+def setup_gdrive(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    drive = patch_drive(fakes, args)
+    content = make_image(7, (800, 600))
+
+    async def call(i: int):
+        gfile = await drive.upload(content, temporary=True)
+        drive.schedule_delete(gfile.id)
+    return call
+
+# ---------------- хэндлеры бота через заглушку Bot API
+
+class BotDriver:
+    """Подает в диспетчер `botmain` обновления от разных пользователей; ответы уходят в заглушку Bot API."""
+
+    def __init__(self, fakes: FakeServices):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        import botmain
+        self.dp = botmain.dp
+        self.bot = Bot(os.environ['BOT_TOKEN'], session=AiohttpSession(api=TelegramAPIServer.from_base(fakes.base)))
+        self._update_id = 0
+
+    async def feed(self, user_id: int, text: str = None, photo: str = None, callback: str = None):
+        from aiogram.types import Update
+        self._update_id += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        message = {'message_id': self._update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': user}
+        if photo:
+            message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 1600, 'height': 1200}]
+        elif text:
+            message['text'] = text
+        raw = {'update_id': self._update_id}
+        if callback:
+            raw['callback_query'] = {'id': str(self._update_id), 'from': user, 'chat_instance': str(user_id),
+                                     'data': callback, 'message': message}
+        else:
+            raw['message'] = message
+        await self.dp.feed_update(self.bot, Update.model_validate(raw, context={'bot': self.bot}))
+
+def setup_bot_search(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    import imgsearch
+    imgsearch.SEARCH_URL = f'{fakes.base}/customsearch/v1'
+    driver = BotDriver(fakes)
+
+    async def call(i: int):
+        user = 1000 + i
+        await driver.feed(user, text='/start')
+        await driver.feed(user, text='bench' if args.warm else f'bench {i}')
+        await driver.feed(user, text=str(args.images))
+    return call
+
+def setup_bot_caption(fakes: FakeServices, args, requests: int) -> Callable[[int], Awaitable]:
+    import imgcap
+    import translator
+    translator.BASE_URL = f'{fakes.base}/translate/v2'
+    imgcap.MODELS.preload()
+    imgcap.INFERENCE.start()
+    driver = BotDriver(fakes)
+
+    async def call(i: int):
+        user = 2000 + i
+        await driver.feed(user, text='/start')
+        await driver.feed(user, photo='pic' if args.warm else f'pic{i}')
+        await driver.feed(user, callback='✍ Описание')
+    return call
+
+SETUPS = {'search': setup_search, 'similar': setup_similar, 'translate': setup_translate, 'gdrive': setup_gdrive,
+          'bot_search': setup_bot_search, 'bot_caption': setup_bot_caption}
+
+# ============================================================ #
+
+def print_result(res: dict, old: Optional[dict] = None):
+    lat = res['latency_ms']
+    line = (f"{res['name']:<12} {res['requests']:>5} x{res['concurrency']:<4} ошибок {res['errors']:<3} "
+            f"{res['throughput_rps']:>8.2f} rps  p50 {lat['p50']:>8.1f}  p95 {lat['p95']:>8.1f}  "
+            f"p99 {lat['p99']:>8.1f} мс  RSS {res['peak_rss_mb']:.0f} MB")
+    if old:
+        def delta(new: float, prev: float) -> str:
+            return f'{(new - prev) / prev * 100:+.0f}%' if prev else 'n/a'
+        line += (f"  [rps {delta(res['throughput_rps'], old['throughput_rps'])}, "
+                 f"p95 {delta(lat['p95'], old['latency_ms']['p95'])}]")
+    print(line)
+
+async def run(args) -> dict:
+    fakes = FakeServices(latency=args.latency)
+    await fakes.start()
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'args': vars(args), 'scenarios': []}
+    previous = {}
+    if args.compare:
+        previous = {s['name']: s for s in json.loads(Path(args.compare).read_text(encoding='utf-8'))['scenarios']}
+    try:
+        for name in args.scenarios:
+            requests, concurrency, title = SCENARIOS[name]
+            requests, concurrency = args.requests or requests, args.concurrency or concurrency
+            print(f'{name}: {title} ...')
+            try:
+                call = SETUPS[name](fakes, args, requests)
+            except ImportError as err:
+                print(f'  пропущен: {err}')
+                continue
+            res = await run_load(name, requests, concurrency, call)
+            report['scenarios'].append(res)
+            print_result(res, previous.get(name, None))
+    finally:
+        from requestor import POOL
+        if 'imgsimilar' in sys.modules:
+            await sys.modules['imgsimilar'].LOCAL_SERVER.stop()
+            await sys.modules['imgsimilar'].DRIVE.stop()
+        await POOL.aclose()
+        await fakes.stop()
+    report['requests_served'] = fakes.requests
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=DEFAULT_SCENARIOS, help=', '.join(SCENARIOS))
+    parser.add_argument('-n', '--requests', type=int, default=None, help='запросов в сценарии')
+    parser.add_argument('-c', '--concurrency', type=int, default=None, help='одновременных запросов')
+    parser.add_argument('--images', type=int, default=50, help='картинок в одном поиске')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа заглушек, сек.')
+    parser.add_argument('--drive-latency', type=float, default=0.2, help='задержка вызова Google Drive, сек.')
+    parser.add_argument('--similar-upload', choices=['direct', 'local', 'gdrive'], default='direct')
+    parser.add_argument('--warm', action='store_true', help='одинаковые запросы (проверка кэшей)')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('-o', '--output', help='куда сохранить JSON (по умолчанию bench/results/<время>.json)')
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if not name in SCENARIOS]
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(unknown)}')
+
+    report = asyncio.run(run(args))
+    output = Path(args.output) if args.output else RESULTS / f'{time.strftime("%Y%m%d-%H%M%S")}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f'Результаты: {output}')
+
+if __name__ == '__main__':
+    main()
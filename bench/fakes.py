@@ -0,0 +1,142 @@
+"""Локальные заглушки внешних сервисов для бенчмарков: Google Custom Search, хостинг картинок,
+Яндекс (поиск по картинке), Yandex Translate и Telegram Bot API. Все на одном aiohttp-сервере,
+с настраиваемой задержкой ответа (имитация сети)."""
+import os
+import json
+import zlib
+import random
+import asyncio
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+from aiohttp import web
+from PIL import Image
+
+# ============================================================ #
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+IMAGE_VARIANTS = 16         # разных картинок на хостинге (ссылки повторяются по кругу)
+
+# ============================================================ #
+
+def setup_env():
+    """Настройки бота читаются при импорте `config`: до него подставляем безопасные значения
+    (без `.env`), а лог уводим во временный каталог, чтобы не перезаписывать `log.log` бота."""
+    for key, value in {'BOT_TOKEN': '123456:bench', 'BOT_NAME': 'bench', 'GOOGLE_CX': 'bench', 'GOOGLE_API_KEY': 'bench',
+                       'YANDEX_API_KEY': 'bench', 'REDIS': 'false', 'REMOTE_WORKERS': 'false', 'SIMILAR_UPLOAD': 'direct',
+                       'TRANSLATOR': 'yandex', 'LOG_FILE': str(Path(tempfile.gettempdir()) / 'imagebot-bench.log')}.items():
+        os.environ.setdefault(key, value)
+
+def make_image(seed: int, size: tuple[int, int] = (1600, 1200), quality: int = 90) -> bytes:
+    """Шумная картинка: плохо сжимается, поэтому перекодирование нагружает CPU как настоящие фото."""
+    rnd = random.Random(seed)
+    small = Image.frombytes('RGB', (size[0] // 16, size[1] // 16), rnd.randbytes(size[0] // 16 * size[1] // 16 * 3))
+    img = small.resize(size, Image.BILINEAR)
+    out = BytesIO()
+    img.save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+class FakeServices:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, image_size: tuple[int, int] = (1600, 1200)):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.images = [make_image(i, image_size) for i in range(IMAGE_VARIANTS)]
+        self.html = (FIXTURES / 'yandex_cbir.html').read_text(encoding='utf-8')
+        self.requests: dict[str, int] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self._message_id = 0
+
+    @property
+    def base(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def _delay(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # ---------------- Google Custom Search и картинки
+
+    async def _cse(self, request: web.Request) -> web.Response:
+        await self._delay('cse')
+        start, num = int(request.query.get('start', 1)), int(request.query.get('num', 10))
+        items = [{'link': f'{self.base}/img/{i}.jpg'} for i in range(start, start + num)]
+        return web.json_response({'items': items})
+
+    async def _image(self, request: web.Request) -> web.Response:
+        await self._delay('image')
+        i = int(request.match_info['i'])
+        return web.Response(body=self.images[i % IMAGE_VARIANTS], content_type='image/jpeg')
+
+    # ---------------- Яндекс: страница выдачи и загрузка картинки
+
+    async def _yandex_get(self, request: web.Request) -> web.Response:
+        await self._delay('yandex_page')
+        return web.Response(text=self.html, content_type='text/html')
+
+    async def _yandex_post(self, request: web.Request) -> web.Response:
+        await self._delay('yandex_upload')
+        await request.read()
+        return web.json_response({'blocks': [{'params': {'url': f'rpt=imageview&cbir_id={random.getrandbits(64):x}'}}]})
+
+    # ---------------- Yandex Translate
+
+    async def _translate(self, request: web.Request) -> web.Response:
+        await self._delay('translate')
+        payload = await request.json()
+        return web.json_response({'translations': [{'text': f'[{payload["targetLanguageCode"]}] {t}'} for t in payload['texts']]})
+
+    # ---------------- Telegram Bot API
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {'message_id': self._message_id, 'date': 0, 'chat': {'id': int(chat_id), 'type': 'private'}} | extra
+
+    async def _bot_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        await self._delay(f'bot_{method}')
+        form = await request.post()
+        chat_id = form.get('chat_id', 0)
+        if method == 'getfile':
+            file_id = form['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'}
+        elif method == 'sendmediagroup':
+            result = [self._message(chat_id) for _ in json.loads(form['media'])]
+        elif method.startswith('send') and method != 'sendchataction':
+            result = self._message(chat_id, text=form.get('text', None))
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _bot_file(self, request: web.Request) -> web.Response:
+        await self._delay('bot_file')
+        # стабильный хэш: hash() строк меняется от запуска к запуску (PYTHONHASHSEED), а замеры должны повторяться
+        i = zlib.crc32(request.match_info['path'].encode())
+        return web.Response(body=self.images[i % IMAGE_VARIANTS], content_type='image/jpeg')
+
+    # ----------------
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get('/customsearch/v1', self._cse)
+        app.router.add_get('/img/{i}.jpg', self._image)
+        # httpx дописывает к базовому URL косую черту
+        for path in ('/images/search', '/images/search/'):
+            app.router.add_get(path, self._yandex_get)
+            app.router.add_post(path, self._yandex_post)
+        app.router.add_post('/translate/v2/translate', self._translate)
+        app.router.add_post('/bot{token}/{method}', self._bot_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self._bot_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if not self._runner is None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -8,9 +8,7 @@ import gc
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 # from aiogram.utils import markdown as md
-from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from aiogram.types import (ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton, 
-                           Message, BufferedInputFile, ReplyKeyboardRemove, CallbackQuery)
+from aiogram.types import Message, ReplyKeyboardRemove, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -20,9 +18,18 @@ from aiogram.utils.chat_action import ChatActionMiddleware, ChatActionSender
 from io import BytesIO
 
 from config import CONFIG
+from cache import LRUCache
+from requestor import POOL
 import imgsearch
 import imgcap
 import imgsimilar
+import translator
+from jobqueue import JobQueue, Job, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from webhook import WebhookServer
+from admission import AdmissionMiddleware, search_cost, action_cost
+import metrics
+from ui import (BTNS_IMG_ACTIONS, NL, BUSY_REPLY, make_keyboard_inline, 
+                similar_reply, send_search_results)
 
 # ============================================================ #
 
@@ -33,10 +40,8 @@ BOT_HELP = \
 """
 
 BTNS_NUMBER_IMAGES = ['1', '3', '5', '7', '10', '15', '20', '30', '40', '50', '❌ Отмена']
-BTNS_IMG_ACTIONS = ['✍ Описание', '❓ Вопрос', '👥 Похожие', '❌ Отмена']
-NL = '\n'
 INFLECT_REPLY = {'1': 'картинка', '2': 'картинки', '3': 'картинки', '4': 'картинки'}
-REDIS_URL = 'redis://redis:6379'
+REDIS_URL = CONFIG.redis_url
 
 # ============================================================ #
 
@@ -48,7 +53,36 @@ if IS_LINUX and CONFIG.redis:
 else:
     storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+if IS_LINUX and CONFIG.redis:
+    imgcap.RESULTS.redis = storage.redis
+    translator.CACHE.redis = storage.redis
+    imgsimilar.CACHE.redis = storage.redis
+# тяжелые задачи отдаем удаленным воркерам (`python worker.py`), если они включены
+QUEUE = JobQueue(storage.redis) if IS_LINUX and CONFIG.redis and CONFIG.remote_workers else None
 dp.message.middleware(ChatActionMiddleware())
+admission = None
+if CONFIG.admission:
+    # с удаленными воркерами бот тяжелую работу не делает - остаются только лимиты пользователя
+    admission = AdmissionMiddleware(CONFIG.heavy_slots, CONFIG.user_concurrency, CONFIG.rate_burst, CONFIG.rate_per_minute,
+                                    schedule=QUEUE is None)
+    dp.message.middleware(admission)
+    dp.callback_query.middleware(admission)
+
+# ============================================================ #
+
+class ImageSession:
+    """Загруженная в чате картинка и её предобработанные тензоры (живут до сброса состояния)."""
+
+    def __init__(self, file_id: str, content: bytes):
+        self.file_id = file_id
+        self.content = content
+        self.imcap: imgcap.Imgcap = None
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.content) + (self.imcap.nbytes if self.imcap else 0)
+
+SESSIONS = LRUCache(CONFIG.session_size, CONFIG.session_ttl, CONFIG.session_bytes, lambda s: s.nbytes)
 
 # ============================================================ #
 
@@ -60,30 +94,53 @@ class MyStates(StatesGroup):
 
 # ============================================================ #
 
-def make_keyboard(items: list[str], placeholder: str = 'Выберите действие', cols: int = 3) -> ReplyKeyboardMarkup:
-    builder = ReplyKeyboardBuilder()
-    builder.add(*[KeyboardButton(text=item) for item in items])
-    builder.adjust(min(cols, len(items)))
-    return builder.as_markup(resize_keyboard=True, input_field_placeholder=placeholder or None)
-
-def make_keyboard_inline(items: list[dict], cols: int = 3) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.add(*[InlineKeyboardButton(**item) for item in items])
-    builder.adjust(min(cols, len(items)))
-    return builder.as_markup(resize_keyboard=True)
-
 def inflect_num(num: int) -> str:
     last = str(num)[-1]
     return INFLECT_REPLY.get(last, 'картинок')
 
+async def clear_state(state: FSMContext):
+    SESSIONS.pop(state.key.chat_id)
+    await state.clear()
+
+async def enqueue(msg: Message, kind: str, priority: int, **payload):
+    await QUEUE.put(Job(kind=kind, chat_id=msg.chat.id, payload=payload, priority=priority))
+    await msg.answer('⏳ Запрос поставлен в очередь, результат придет сюда же ...', reply_markup=ReplyKeyboardRemove())
+
+def get_session(state: FSMContext, file_id: str) -> ImageSession:
+    session = SESSIONS.get(state.key.chat_id)
+    return session if session and session.file_id == file_id else None
+
+async def get_imgcap(state: FSMContext, file_id: str, pic: BytesIO, uid: str = None) -> imgcap.Imgcap:
+    session = get_session(state, file_id)
+    if session and session.imcap:
+        return session.imcap
+    imcap = await imgcap.Imgcap.open(pic, uid)
+    if session:
+        session.imcap = imcap
+        # перезаписываем, чтобы учесть объем картинки
+        SESSIONS.set(state.key.chat_id, session)
+    return imcap
+
+def update_session(state: FSMContext, file_id: str):
+    # после инференса в сессии другие тензоры (эмбеддинги вместо пикселей): пересчитываем ее объем
+    session = get_session(state, file_id)
+    if session:
+        SESSIONS.set(state.key.chat_id, session)
+
 async def download_file(callback: CallbackQuery, message: Message, state: FSMContext, bot: Bot, file_id: str) -> BytesIO:
+    session = get_session(state, file_id)
+    if session:
+        return BytesIO(session.content)
     msg = message or callback.message
     await msg.answer(f'⏳ Загрузка изображения ...', reply_markup=ReplyKeyboardRemove())
     try:
-        return await bot.download(file_id)
+        with metrics.timer('telegram_download'):
+            pic = await bot.download(file_id)
+        SESSIONS.set(state.key.chat_id, ImageSession(file_id, pic.getvalue()))
+        return pic
     except Exception as err:
         logging.debug(err, exc_info=True)
-        await state.clear()
+        await clear_state(state)
         await state.set_state(MyStates.start_state)
         await msg.answer('⛔ Ошибка загрузки картинки, попробуй загрузить заново', 
                                         reply_markup=ReplyKeyboardRemove())
@@ -96,27 +153,17 @@ async def download_file(callback: CallbackQuery, message: Message, state: FSMCon
 @dp.message(Command(commands=['start', 'help']))
 async def start(message: Message, state: FSMContext):
     if message.text != '/help':
-        await state.clear()
+        await clear_state(state)
         await state.set_state(MyStates.start_state)
     await message.answer(BOT_HELP)
 
 # ================ 2 - ПОИСК КАРТИНОК ПО ТЕКСТУ
 
 async def send_images(q: str, num: int, message: Message, state: FSMContext):    
-    results = imgsearch.search(q=q, num=num)
-    if results:
-        for i, res in enumerate(results):
-            reply_markup = ReplyKeyboardRemove() if i == 0 else None
-            try:
-                await message.answer_photo(BufferedInputFile(res.img, res.filename), 
-                                           reply_markup=reply_markup)
-            except Exception as err:
-                logging.exception(err, exc_info=False)
-                # await message.answer(f'😩 Не смог загрузить изображение {i+1}', reply_markup=reply_markup)
-                continue
-    else:
+    found = await send_search_results(message.bot, message.chat.id, q, num)
+    if not found:
         await message.answer('🤔 Картинки не найдены', reply_markup=ReplyKeyboardRemove())
-    await state.clear()
+    await clear_state(state)
     await state.set_state(MyStates.start_state)
 
 async def process_image_search(q: str, state: FSMContext, message: Message = None, callback: CallbackQuery = None):
@@ -129,7 +176,7 @@ async def process_image_search(q: str, state: FSMContext, message: Message = Non
         return
 
     if num < 1:
-        await state.clear()
+        await clear_state(state)
         await state.set_state(MyStates.start_state)
         await msg.answer('🤷 Нет так нет...', reply_markup=ReplyKeyboardRemove())
         return
@@ -140,46 +187,51 @@ async def process_image_search(q: str, state: FSMContext, message: Message = Non
     await msg.answer(f'🔎 Ищу "{q}" в Google ({num} {inflect_num(num)}) ...', 
                             reply_markup=ReplyKeyboardRemove())
     
+    if QUEUE:
+        await enqueue(msg, 'search', PRIORITY_LOW, q=q, num=num)
+        await clear_state(state)
+        await state.set_state(MyStates.start_state)
+        return
     await send_images(q, num, msg, state)
 
 @dp.message(MyStates.start_state, F.text)
 async def search_images_get_query(message: Message, state: FSMContext):
-    await state.clear()
+    await clear_state(state)
     await state.set_state(MyStates.search_state)
     await state.update_data(q=message.text)
     await message.answer(f'❓ Сколько картинок найти (от 1 до {imgsearch.MAX_NUMBER})?{NL}Нажми или отправь "отмена" для отмены поиска.', 
                          reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_NUMBER_IMAGES], 5))
     
-@dp.message(MyStates.search_state, F.text.regexp(r'(\d+)|(.*отмена)', flags=re.I))
+@dp.message(MyStates.search_state, F.text.regexp(r'(\d+)|(.*отмена)', flags=re.I), flags={'cost': search_cost})
 async def search_images_process_query(message: Message, state: FSMContext, bot: Bot):    
     async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id, interval=2.0):
         data = await state.get_data()
         if not 'q' in data:
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await message.answer('⛔ Не указана ключевая фраза для поиска', 
                                 reply_markup=ReplyKeyboardRemove())
             return
         if message.text.lower() == 'отмена':
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await message.answer('🤷 Нет так нет...', reply_markup=ReplyKeyboardRemove())
         else:
             await process_image_search(data['q'], state, message)
 
-@dp.callback_query(MyStates.search_state, F.data.regexp(r'(\d+)|(.*отмена)', flags=re.I))
+@dp.callback_query(MyStates.search_state, F.data.regexp(r'(\d+)|(.*отмена)', flags=re.I), flags={'cost': search_cost})
 async def search_images_process_query_callback(callback: CallbackQuery, state: FSMContext, bot: Bot):    
     async with ChatActionSender.typing(bot=bot, chat_id=callback.message.chat.id, interval=2.0):
         data = await state.get_data()
         if not 'q' in data:
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await callback.message.answer('⛔ Не указана ключевая фраза для поиска', 
                                           reply_markup=ReplyKeyboardRemove())
             await callback.answer()
             return
         if callback.data.lower() == 'отмена':
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await callback.message.answer('🤷 Нет так нет...', reply_markup=ReplyKeyboardRemove())
         else:
@@ -191,21 +243,21 @@ async def search_images_process_query_callback(callback: CallbackQuery, state: F
 @dp.message(MyStates.start_state, F.photo)
 async def image_load(message: Message, state: FSMContext, bot: Bot):
     async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id, interval=2.0):
-        await state.clear()
+        await clear_state(state)
         await state.set_state(MyStates.img_load_state)
         # await message.answer(f'⏳ Пять сек, загружаю картинку ...', reply_markup=ReplyKeyboardRemove())
-        await state.update_data(pic=message.photo[-1].file_id)
+        await state.update_data(pic=message.photo[-1].file_id, uid=message.photo[-1].file_unique_id)
         await message.answer('❓ Что делаем дальше?                        ❓', 
                             reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3))
 
 # ================ 4 - ПОЛУЧЕНИЕ ОПИСАНИЯ ИЛИ ОТВЕТ НА ВОПРОС К КАРТИНКЕ
 
-@dp.callback_query(MyStates.img_load_state, F.data.in_(BTNS_IMG_ACTIONS))
+@dp.callback_query(MyStates.img_load_state, F.data.in_(BTNS_IMG_ACTIONS), flags={'cost': action_cost})
 async def image_process_action(callback: CallbackQuery, state: FSMContext, bot: Bot):
     async with ChatActionSender.typing(bot=bot, chat_id=callback.message.chat.id, interval=2.0):
         data = await state.get_data()
         if not 'pic' in data:
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await callback.message.answer('⛔ Изображение не сохранено, попробуй загрузить заново', 
                                           reply_markup=ReplyKeyboardRemove())
@@ -214,14 +266,27 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
 
         if callback.data.endswith('писание'):
 
+            summary = await imgcap.Imgcap.cached_summary(data.get('uid'), 3)
+            if summary:
+                await callback.message.answer('. '.join(summary), reply_markup=ReplyKeyboardRemove())
+                await callback.message.answer('❓ Еще что-то?                                         ❓', 
+                                              reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3))
+                await callback.answer()
+                return
+
+            if QUEUE:
+                await enqueue(callback.message, 'caption', PRIORITY_HIGH, file_id=data['pic'], uid=data.get('uid'), number=3)
+                await callback.answer()
+                return
+
             pic = await download_file(callback, None, state, bot, data['pic'])
             if pic is None: return
 
             try:
-                imcap = imgcap.Imgcap(pic)
+                imcap = await get_imgcap(state, data['pic'], pic, data.get('uid'))
             except Exception as err:
                 logging.debug(err, exc_info=True)
-                await state.clear()
+                await clear_state(state)
                 await state.set_state(MyStates.start_state)
                 await callback.message.answer('⛔ Ошибка загрузки картинки, попробуй загрузить заново', 
                                               reply_markup=ReplyKeyboardRemove())
@@ -231,8 +296,14 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
                 gc.collect(0)
                 return
 
-            summary = await imcap.summary(3)
-            await callback.message.answer('. '.join(summary) if summary else '🤔 Описание не найдено', reply_markup=ReplyKeyboardRemove())
+            try:
+                summary = await imcap.summary(3)
+            except imgcap.InferenceBusyError as err:
+                logging.warning(err)
+                await callback.message.answer(BUSY_REPLY, reply_markup=ReplyKeyboardRemove())
+            else:
+                update_session(state, data['pic'])
+                await callback.message.answer('. '.join(summary) if summary else '🤔 Описание не найдено', reply_markup=ReplyKeyboardRemove())
             await callback.message.answer('❓ Еще что-то?                                         ❓', 
                                           reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3))
             await callback.answer()
@@ -246,12 +317,17 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
 
             await callback.message.answer('Задай свой вопрос 👇', reply_markup=ReplyKeyboardRemove())
             await state.set_state(MyStates.img_question_state)
-            await state.update_data(pic=data['pic'])
+            await state.update_data(pic=data['pic'], uid=data.get('uid'))
             await callback.answer()
             return
 
         elif callback.data.endswith('охожие'):
 
+            if QUEUE:
+                await enqueue(callback.message, 'similar', PRIORITY_NORMAL, file_id=data['pic'])
+                await callback.answer()
+                return
+
             pic = await download_file(callback, None, state, bot, data['pic'])
             if pic is None: return
 
@@ -260,7 +336,7 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
                 result: imgsimilar.SimilarResult = await imsim.upload_and_parse(pic.getvalue())
             except Exception as err:
                 logging.debug(err, exc_info=True)
-                await state.clear()
+                await clear_state(state)
                 await state.set_state(MyStates.start_state)
                 await callback.message.answer('⛔ Ошибка при поиске похожих картинок', 
                                               reply_markup=ReplyKeyboardRemove())
@@ -270,14 +346,7 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
                 gc.collect(0)
                 return
             else:
-                sreply = ''
-                if result.title and result.subtitle:
-                    sreply += f'{result.title} - {result.subtitle}{NL}'
-                if result.tags:
-                    sreply += '🟢 ' + f'{NL}🟢 '.join(result.tags) + NL
-                if result.similar:
-                    sreply += f'Найдено {len(result.similar)} похожих изображений'
-                await callback.message.answer(sreply, 
+                await callback.message.answer(similar_reply(result), 
                                               reply_markup=make_keyboard_inline([{'text': '🔺 Открыть ссылку', 'url': result.url}], 1))
                 await callback.message.answer('❓ Еще что-то?                                         ❓', 
                                               reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3))
@@ -288,37 +357,56 @@ async def image_process_action(callback: CallbackQuery, state: FSMContext, bot:
                 gc.collect(0)
                 return
 
-        await state.clear()
+        await clear_state(state)
         await state.set_state(MyStates.start_state)
         await callback.message.answer('🤷 Нет так нет...', reply_markup=ReplyKeyboardRemove())
         await callback.answer()
 
 # ================ 5 - ОТВЕТ НА ВОПРОС К КАРТИНКЕ
 
-@dp.message(MyStates.img_question_state, F.text)
+@dp.message(MyStates.img_question_state, F.text, flags={'cost': 'vqa'})
 async def image_answer(message: Message, state: FSMContext, bot: Bot):
     async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id, interval=2.0):
         data = await state.get_data()
         if not 'pic' in data:
-            await state.clear()
+            await clear_state(state)
             await state.set_state(MyStates.start_state)
             await message.answer('⛔ Изображение не сохранено, попробуй загрузить заново', 
                                  reply_markup=ReplyKeyboardRemove())
             return
+
+        answer = await imgcap.Imgcap.cached_answer(data.get('uid'), message.text, 'ru')
+        if not answer is None:
+            await message.answer(answer or '🤔 Ответ не найден', reply_markup=ReplyKeyboardRemove())
+            await state.set_state(MyStates.img_load_state)
+            await message.answer('❓ Еще что-то?                                         ❓', 
+                                 reply_markup=make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3))
+            return
+
+        if QUEUE:
+            await enqueue(message, 'vqa', PRIORITY_HIGH, file_id=data['pic'], uid=data.get('uid'), question=message.text, lang='ru')
+            await state.set_state(MyStates.img_load_state)
+            return
         
         pic = await download_file(None, message, state, bot, data['pic'])
         if pic is None: return
         
         try:
-            imcap = imgcap.Imgcap(pic)
+            imcap = await get_imgcap(state, data['pic'], pic, data.get('uid'))
         except Exception as err:
             logging.debug(err, exc_info=True)
             await message.answer('⛔ Ошибка загрузки картинки, попробуй загрузить заново', 
                                  reply_markup=ReplyKeyboardRemove())
         else:
             await message.answer(f'⏳ Чуточку подождём (до 3 минут) ...', reply_markup=ReplyKeyboardRemove())
-            answer = await imcap.answer(message.text, 'ru')
-            await message.answer(answer or '🤔 Ответ не найден', reply_markup=ReplyKeyboardRemove())
+            try:
+                answer = await imcap.answer(message.text, 'ru')
+            except imgcap.InferenceBusyError as err:
+                logging.warning(err)
+                await message.answer(BUSY_REPLY, reply_markup=ReplyKeyboardRemove())
+            else:
+                update_session(state, data['pic'])
+                await message.answer(answer or '🤔 Ответ не найден', reply_markup=ReplyKeyboardRemove())
         
         pic.close()
         await state.set_state(MyStates.img_load_state)
@@ -329,8 +417,48 @@ async def image_answer(message: Message, state: FSMContext, bot: Bot):
 
 # ============================================================ #
 
+def track_metrics(server: WebhookServer = None):
+    metrics.track_gauge('inference_pending', 'Задачи в пуле инференса (выполняются и ждут)', lambda: imgcap.INFERENCE.pending)
+    metrics.track_gauge('sessions', 'Картинки в памяти сессий', lambda: len(SESSIONS))
+    metrics.track_gauge('sessions_bytes', 'Объем сессий в памяти', lambda: SESSIONS.nbytes)
+    if admission:
+        metrics.track_gauge('admission_active', 'Занятые слоты тяжелой работы', lambda: admission.scheduler.active)
+        metrics.track_gauge('admission_waiting', 'Запросы в очереди на тяжелую работу', lambda: admission.scheduler.waiting)
+    if server:
+        metrics.track_gauge('webhook_pending', 'Необработанные обновления вебхука', lambda: server.pending)
+    metrics.track_cache('results', imgcap.RESULTS)
+    metrics.track_cache('translations', translator.CACHE)
+    metrics.track_cache('similar', imgsimilar.CACHE)
+    metrics.track_cache('search', imgsearch.SEARCH_CACHE)
+
 async def main():
-    await dp.start_polling(bot, skip_updates=True)
+    if CONFIG.preload_models and CONFIG.inference_pool != 'process':
+        imgcap.MODELS.preload()
+    imgcap.INFERENCE.start()
+    server = None
+    if CONFIG.webhook_url:
+        # без заданного секрета WebhookServer сгенерирует свой: открытого эндпоинта не бывает
+        secret = CONFIG.webhook_secret.get_secret_value() if CONFIG.webhook_secret else None
+        server = WebhookServer(dp, bot, CONFIG.webhook_url, CONFIG.webhook_path, CONFIG.webhook_host, CONFIG.webhook_port,
+                               secret, CONFIG.update_concurrency, CONFIG.update_queue, CONFIG.webhook_drain_timeout)
+    track_metrics(server)
+    metrics.start(CONFIG.metrics_host, CONFIG.metrics_port)
+    tasks = []
+    if QUEUE:
+        tasks.append(asyncio.create_task(metrics.poll_gauge('jobs_pending', 'Задачи в очереди удаленных воркеров', QUEUE.size)))
+    try:
+        if server:
+            # вебхук: обновления обрабатываются параллельно, а при перезапуске не теряются
+            await server.run()
+        else:
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+        imgcap.INFERENCE.shutdown()
+        await imgsimilar.LOCAL_SERVER.stop()
+        await imgsimilar.DRIVE.stop()
+        await POOL.aclose()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,181 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, Optional, Hashable, Callable
+
+from requestor import serialize, deserialize
+
+#==============================================================================#
+
+REDIS_PREFIX = 'imagebot:'
+MISSING = object()
+
+#==============================================================================#
+
+class LRUCache:
+    """Кэш в памяти процесса с вытеснением по LRU, времени жизни записей
+    и (если задана функция `sizeof`) по суммарному объему в байтах."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600, 
+                 maxbytes: Optional[int] = None, sizeof: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._data: OrderedDict = OrderedDict()
+        self.nbytes = 0
+
+    def _size(self, value: Any) -> int:
+        return self._sizeof(value) if self._sizeof else 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, None)
+        if item is None:
+            return default
+        expires, _, value = item
+        if not expires is None and expires < time.monotonic():
+            self.pop(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        # повторная запись того же ключа пересчитывает размер (значение могло вырасти)
+        self.pop(key)
+        ttl = ttl or self.ttl
+        size = self._size(value)
+        self._data[key] = (time.monotonic() + ttl if ttl else None, size, value)
+        self.nbytes += size
+        while len(self._data) > self.maxsize or \
+              (self.maxbytes and self.nbytes > self.maxbytes and len(self._data) > 1):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self.nbytes -= size
+
+    def keys(self) -> list:
+        now = time.monotonic()
+        return [key for key, (expires, _, _) in self._data.items() if expires is None or expires >= now]
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.nbytes -= item[1]
+        return item[2]
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+#==============================================================================#
+
+class Cache:
+    """Двухуровневый кэш: LRU в памяти и (если подключен) Redis, общий для всех процессов бота.
+    Значения в Redis хранятся в JSON, поэтому должны сериализоваться `orjson`."""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: Optional[int] = 3600, redis=None):
+        self.name = name
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize, ttl)
+        self.redis = redis
+        self.hits = 0
+        self.misses = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f'{REDIS_PREFIX}{self.name}:{key}'
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        value = self.memory.get(key, MISSING)
+        if value is MISSING and not self.redis is None:
+            try:
+                raw = await self.redis.get(self._redis_key(key))
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+                raw = None
+            if not raw is None:
+                value = deserialize(raw)
+                self.memory.set(key, value)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        logging.debug(f'Cache [{self.name}]: Найдено "{key}"')
+        return value
+
+    async def set(self, key: str, value: Any):
+        self.memory.set(key, value)
+        if not self.redis is None:
+            try:
+                await self.redis.set(self._redis_key(key), serialize(value), ex=self.ttl)
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+
+    async def pop(self, key: str):
+        self.memory.pop(key)
+        if not self.redis is None:
+            try:
+                await self.redis.delete(self._redis_key(key))
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+
+#==============================================================================#
+
+class DiskCache:
+    """Кэш в каталоге на диске (по файлу `pickle` на ключ) с вытеснением 
+    по времени жизни и суммарному объему; сначала удаляются самые давно использованные файлы."""
+
+    def __init__(self, path: str, ttl: Optional[float] = 3600, maxbytes: Optional[int] = None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+
+    def _file(self, key: str) -> Path:
+        return self.path / (hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+    def get(self, key: str, default: Any = None) -> Any:
+        f = self._file(key)
+        try:
+            if self.ttl and f.stat().st_mtime + self.ttl < time.time():
+                f.unlink(missing_ok=True)
+                return default
+            value = pickle.loads(f.read_bytes())
+            os.utime(f, (time.time(), f.stat().st_mtime))
+            return value
+        except FileNotFoundError:
+            return default
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+            return default
+
+    def set(self, key: str, value: Any, created: Optional[float] = None):
+        """С `created` (время создания значения) запись истекает по нему, а не по времени перезаписи файла."""
+        f = self._file(key)
+        tmp = f.with_suffix('.tmp')
+        tmp.write_bytes(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        tmp.replace(f)
+        if not created is None:
+            os.utime(f, (time.time(), created))
+        self.evict()
+
+    def pop(self, key: str):
+        self._file(key).unlink(missing_ok=True)
+
+    def evict(self):
+        files = [(f, f.stat()) for f in self.path.glob('*.pkl')]
+        now = time.time()
+        total = 0
+        for f, st in sorted(files, key=lambda x: x[1].st_atime, reverse=True):
+            if (self.ttl and st.st_mtime + self.ttl < now) or (self.maxbytes and total + st.st_size > self.maxbytes):
+                f.unlink(missing_ok=True)
+            else:
+                total += st.st_size
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import SecretStr
+from pydantic import SecretStr, model_validator
 import logging
+import multiprocessing
 from pathlib import Path
 from typing import Optional
 
@@ -12,7 +13,59 @@ ENC = 'utf-8'
 
 class Settings(BaseSettings):
     debug: Optional[bool] = False
+    log_file: Optional[str] = str(Path(__file__).parent / 'log.log')
     redis: Optional[bool] = True
+    redis_url: Optional[str] = 'redis://redis:6379'
+    remote_workers: Optional[bool] = False
+    worker_concurrency: Optional[int] = 4
+    webhook_url: Optional[str] = None
+    webhook_path: Optional[str] = '/webhook'
+    webhook_host: Optional[str] = '0.0.0.0'
+    webhook_port: Optional[int] = 8080
+    webhook_secret: Optional[SecretStr] = None
+    update_concurrency: Optional[int] = 16
+    update_queue: Optional[int] = 1000
+    webhook_drain_timeout: Optional[float] = 30
+    admission: Optional[bool] = True
+    heavy_slots: Optional[int] = 4
+    user_concurrency: Optional[int] = 1
+    rate_burst: Optional[float] = 6
+    rate_per_minute: Optional[float] = 12
+    metrics_host: Optional[str] = '0.0.0.0'
+    metrics_port: Optional[int] = None
+    preload_models: Optional[bool] = False
+    inference_pool: Optional[str] = 'thread'
+    inference_workers: Optional[int] = 1
+    inference_queue: Optional[int] = 8
+    caption_model: Optional[str] = 'large_coco'
+    quantize: Optional[bool] = False
+    torch_threads: Optional[int] = None
+    torch_interop_threads: Optional[int] = None
+    batch_window: Optional[float] = 0.2
+    batch_max: Optional[int] = 8
+    cache_size: Optional[int] = 1024
+    cache_ttl: Optional[int] = 86400
+    session_size: Optional[int] = 256
+    session_ttl: Optional[int] = 900
+    session_bytes: Optional[int] = 512 * 1024 * 1024
+    search_cache_ttl: Optional[int] = 6 * 3600
+    search_cache_bytes: Optional[int] = 256 * 1024 * 1024
+    search_cache_dir: Optional[str] = None
+    http_timeout: Optional[float] = 30.0
+    http_max_connections: Optional[int] = 20
+    http2: Optional[bool] = True
+    translator: Optional[str] = 'yandex'
+    similar_upload: Optional[str] = 'gdrive'
+    similar_local_host: Optional[str] = '0.0.0.0'
+    similar_local_port: Optional[int] = 8081
+    similar_public_url: Optional[str] = None
+    similar_cache_size: Optional[int] = 1024
+    similar_cache_ttl: Optional[int] = 7 * 86400
+    similar_hash_distance: Optional[int] = 6
+    marian_local_only: Optional[bool] = False
+    translate_cache_size: Optional[int] = 4096
+    translate_cache_ttl: Optional[int] = 30 * 86400
+    translate_batch_window: Optional[float] = 0.05
     bot_token: SecretStr
     bot_name: str
     google_cx: SecretStr
@@ -21,10 +74,18 @@ class Settings(BaseSettings):
 
     model_config = SettingsConfigDict(env_file='.env', env_file_encoding=ENC)
 
+    @model_validator(mode='after')
+    def check_similar_upload(self):
+        # Яндекс забирает картинку сам, поэтому локальному серверу нужен внешний адрес
+        if self.similar_upload == 'local' and not self.similar_public_url:
+            raise ValueError('similar_upload=local требует similar_public_url (адрес, доступный из интернета)')
+        return self
+
 CONFIG = Settings()
 
-# логи направляем в файл `log.log` ...
-logging.basicConfig(filename=str(Path(__file__).parent / 'log.log'), filemode='w', style='{',
+# логи направляем в файл `log_file` (перезаписывается только главным процессом, воркеры пула дописывают) ...
+logging.basicConfig(filename=CONFIG.log_file, 
+                    filemode='w' if multiprocessing.parent_process() is None else 'a', style='{',
                     format='[{asctime}] [{levelname}] {message}', datefmt='%d.%m.%Y %H:%M:%S',
                     encoding=ENC, level=logging.DEBUG if CONFIG.debug else logging.INFO)
 # ...а также в консоль (`stderr`)
@@ -4,12 +4,24 @@ from oauth2client.service_account import ServiceAccountCredentials
 from typing import Union, Optional
 from pathlib import Path
 from pydantic import BaseModel
-import httpx, io, os, uuid, mimetypes, tempfile, logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import httpx, httplib2, io, uuid, mimetypes, logging, asyncio, functools
+
+from requestor import POOL
+from metrics import timed
 
 #==============================================================================#
 
 GOOGLE_SECRETS = 'gsecrets.json'
 GOOGLE_SCOPE = ['https://www.googleapis.com/auth/drive']
+TEMP_PREFIX = 'imagebot-tmp-'   # временные загрузки (их подчищает фоновая очистка)
+DELETE_ATTEMPTS = 5
+SWEEP_INTERVAL = 3600           # сек. между поисками забытых временных файлов
+ORPHAN_AGE = 600                # сек., после которых временный файл считается забытым
+SNIFF_BYTES = 16
+MAGIC_BYTES = [(b'\xff\xd8\xff', 'image/jpeg'), (b'\x89PNG\r\n\x1a\n', 'image/png'), 
+               (b'GIF87a', 'image/gif'), (b'GIF89a', 'image/gif')]
 mimetypes.init()
 
 #==============================================================================#
@@ -26,38 +38,91 @@ class Gfile(BaseModel):
 #==============================================================================#
 
 class Gdrive:
+    """Google Drive через PyDrive. Блокирующие вызовы API идут в отдельном потоке
+    (PyDrive не потокобезопасен, поэтому поток один), удаление временных файлов — в фоне."""
+
+    def __init__(self):
+        self._gauth: Optional[GoogleAuth] = None
+        self._gdrive: Optional[GoogleDrive] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='gdrive')
+        self._cleanup: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
 
     def update_creds(self):
+        # ключ сервисного аккаунта читаем один раз, а истекший токен запрашиваем заново
+        if not self._gdrive is None and not self._gauth.access_token_expired:
+            return
         logging.debug('Gdrive: Получение ключа аутентификации ...')
-        gauth = GoogleAuth()
-        gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SECRETS, GOOGLE_SCOPE)
-        self._gdrive = GoogleDrive(gauth)
+        if self._gauth is None:
+            self._gauth = GoogleAuth()
+            self._gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SECRETS, GOOGLE_SCOPE)
+            self._gdrive = GoogleDrive(self._gauth)
+        else:
+            # GoogleAuth.Refresh() требует refresh_token, которого у сервисного аккаунта нет: обновляем сами
+            # учетные данные (авторизованный ими http-клиент PyDrive подхватит новый токен)
+            self._gauth.credentials.refresh(httplib2.Http(timeout=self._gauth.http_timeout))
         logging.debug('Gdrive: Ключ аутентификации получен')
 
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
     @staticmethod
     def generate_uid():
         return uuid.uuid4().hex
 
     @staticmethod
-    async def download(url: str, filetype: str = 'bytes', **kwargs):
-        async with httpx.AsyncClient(**kwargs) as client:
-            r = await client.get(url)
-            # assert r.status_code == 200
-            if filetype == 'bytes':
-                return r.read()
-            if filetype == 'file':
-                file_ = r.read()
-                return io.BytesIO(file_)
-            if filetype == 'text':
-                return r.text
-            if filetype == 'json':
-                return r.json()
+    async def download_url(url: str, filetype: str = 'bytes', client: httpx.AsyncClient = None):
+        r = await (client or POOL.get()).get(url)
+        # assert r.status_code == 200
+        if filetype == 'bytes':
+            return r.read()
+        if filetype == 'file':
+            file_ = r.read()
+            return io.BytesIO(file_)
+        if filetype == 'text':
+            return r.text
+        if filetype == 'json':
+            return r.json()
+
+    @staticmethod
+    def sniff_mime(content: bytes) -> Optional[str]:
+        # тип картинки по сигнатуре в первых байтах
+        for signature, mime in MAGIC_BYTES:
+            if content.startswith(signature):
+                return mime
+        if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+            return 'image/webp'
+        return None
+
+    @staticmethod
+    def get_mime_ext(content_type: Optional[str]) -> str:
+        return (mimetypes.guess_extension(content_type) or '') if content_type else ''
+
+    @staticmethod
+    async def stream_url(url: str, client: httpx.AsyncClient = None) -> tuple:
+        """Скачивает файл потоком: тип определяется по первым байтам, не-картинка отбрасывается сразу."""
+        async with (client or POOL.get()).stream('GET', url) as r:
+            r.raise_for_status()
+            chunks = r.aiter_bytes()
+            head = b''
+            async for chunk in chunks:
+                head += chunk
+                if len(head) >= SNIFF_BYTES: break
+            content_type = Gdrive.sniff_mime(head)
+            if content_type is None:
+                content_type = r.headers.get('content-type', '').split(';')[0].strip() or None
+                if not content_type or not content_type.startswith('image/'):
+                    raise ValueError(f'По ссылке "{url}" не картинка ({content_type})')
+            body = [head]
+            async for chunk in chunks:
+                body.append(chunk)
+        return (content_type, b''.join(body))
             
     @staticmethod
     def get_file_mime(file: str) -> tuple:
         logging.debug(f'Gdrive: Получение MIME файла "{file}" ...')
         content_type = mimetypes.guess_type(file, False)[0]
-        ext = mimetypes.guess_extension(content_type) if content_type else ''
+        ext = Gdrive.get_mime_ext(content_type)
         logging.debug(f'Gdrive: Получение MIME файла "{file}" - ГОТОВО')
         return (content_type, ext)
 
@@ -65,85 +130,128 @@ class Gdrive:
     async def get_file_name_and_content(file: Union[bytes, str]) -> tuple:
         logging.debug('Gdrive: Получение имени и MIME файла ...')
         name = Gdrive.generate_uid()
-        content = None
         if isinstance(file, str):
-            file = file.lower()
-            if file.startswith('http') or file.startswith('ftp'):
-                content = await Gdrive.download(file)
-                f_, fpath = tempfile.mkstemp()
-                with open(f_, 'wb') as f__:
-                    f__.write(content)
-                content_type, ext = Gdrive.get_file_mime(fpath)
-                try: 
-                    os.unlink(fpath)
-                except:
-                    pass
+            if file.lower().startswith('http'):
+                content_type, content = await Gdrive.stream_url(file)
+                ext = Gdrive.get_mime_ext(content_type)
             else:
                 pf = Path(file)
                 content = pf.read_bytes()
-                content_type, ext = Gdrive.get_file_mime(str(pf)) 
+                content_type, ext = Gdrive.get_file_mime(str(pf))
         else:
-            try:
-                f_, fpath = tempfile.mkstemp()
-                with open(f_, 'wb') as f__:
-                    f__.write(file)
-                content_type, ext = Gdrive.get_file_mime(fpath) 
-                try: 
-                    os.unlink(fpath)
-                except:
-                    pass
-            except Exception as err:
-                logging.exception(err, exc_info=True)
+            content = file
+            content_type = Gdrive.sniff_mime(content)
+            ext = Gdrive.get_mime_ext(content_type)
         
         logging.debug('Gdrive: Получение имени и MIME файла - ГОТОВО')
-        return (name + ext, content_type, content or file)
+        return (name + ext, content_type, content)
 
-    async def upload(self, file: Union[str, bytes], replace_id: Optional[str] = None, mimetype: Optional[str] = None) -> Gfile:
+    def _upload(self, fname: str, mime: str, content: bytes, replace_id: Optional[str]) -> Gfile:
         self.update_creds()
-        logging.debug('Gdrive: Загрузка файла ...')
-        fname, mime, content = await Gdrive.get_file_name_and_content(file)
         f = self._gdrive.CreateFile({'id': replace_id} if replace_id else {'title': fname})
         if f['title'] != fname: f['title'] = fname
-        f['mimetype'] = mimetype or mime
+        f['mimetype'] = mime
         f.content = io.BytesIO(content)
         f.Upload()
         f.InsertPermission({'type': 'anyone', 'value': 'anyone', 'role': 'reader'})
         file_id = f['id']
-        filemodel = Gfile(title=f['title'], mime=f['mimetype'], id=file_id, url=f'https://drive.google.com/uc?id={file_id}&export=download')
-        f = None
+        return Gfile(title=f['title'], mime=f['mimetype'], id=file_id, url=self.geturl(file_id))
+
+    @timed('gdrive_upload')
+    async def upload(self, file: Union[str, bytes], replace_id: Optional[str] = None, mimetype: Optional[str] = None, 
+                     temporary: bool = False) -> Gfile:
+        logging.debug('Gdrive: Загрузка файла ...')
+        fname, mime, content = await Gdrive.get_file_name_and_content(file)
+        if temporary:
+            fname = TEMP_PREFIX + fname
+        filemodel = await self._run(self._upload, fname, mimetype or mime, content, replace_id)
         logging.debug('Gdrive: Загрузка файла - ГОТОВО')
         return filemodel
 
-    async def delete(self, file_id: str, permanent: bool = True):
+    def _delete(self, file_id: str, permanent: bool = True):
         self.update_creds()
-        logging.debug(f'Gdrive: Удаление файла {file_id} ...')
         f = self._gdrive.CreateFile({'id': file_id})
         if permanent:
             f.Delete()
         else:
             f.Trash()
+
+    @timed('gdrive_delete')
+    async def delete(self, file_id: str, permanent: bool = True):
+        logging.debug(f'Gdrive: Удаление файла {file_id} ...')
+        await self._run(self._delete, file_id, permanent)
         logging.debug(f'Gdrive: Удаление файла {file_id} - ГОТОВО')
 
-    async def getmeta(self, file_id: str) -> dict:
+    # ---------------- фоновая очистка временных файлов
+
+    def schedule_delete(self, file_id: str):
+        """Ставит файл в очередь на удаление, не дожидаясь его."""
+        self.start()
+        self._cleanup.put_nowait((file_id, 0))
+
+    def start(self):
+        if self._tasks: return
+        self._cleanup = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._cleanup_worker()), asyncio.create_task(self._sweeper())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=False)
+
+    async def _cleanup_worker(self):
+        while True:
+            file_id, attempt = await self._cleanup.get()
+            try:
+                await self.delete(file_id)
+            except Exception as err:
+                logging.warning(f'Gdrive: Не удалось удалить {file_id} (попытка {attempt + 1}): {err}')
+                if attempt + 1 < DELETE_ATTEMPTS:
+                    asyncio.get_running_loop().call_later(2 ** attempt, self._cleanup.put_nowait, (file_id, attempt + 1))
+
+    def _list_orphans(self) -> list[str]:
+        self.update_creds()
+        since = (datetime.now(timezone.utc) - timedelta(seconds=ORPHAN_AGE)).strftime('%Y-%m-%dT%H:%M:%S')
+        query = f"title contains '{TEMP_PREFIX}' and modifiedDate < '{since}' and trashed = false"
+        return [f['id'] for f in self._gdrive.ListFile({'q': query}).GetList()]
+
+    async def _sweeper(self):
+        while True:
+            try:
+                orphans = await self._run(self._list_orphans)
+                if orphans:
+                    logging.info(f'Gdrive: Найдено забытых временных файлов: {len(orphans)}')
+                for file_id in orphans:
+                    self._cleanup.put_nowait((file_id, 0))
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    # ----------------
+
+    def _getmeta(self, file_id: str) -> dict:
         self.update_creds()
         f = self._gdrive.CreateFile({'id': file_id})
         f.FetchMetadata(fetch_all=True)
-        meta = f.metadata
-        f = None
-        return meta
+        return f.metadata
+
+    async def getmeta(self, file_id: str) -> dict:
+        return await self._run(self._getmeta, file_id)
     
     def geturl(self, file_id: str) -> str:
         return f'https://drive.google.com/uc?id={file_id}&export=download'
 
-    async def download(self, file_id: str, filetype: str = 'bytes'):
+    def _download(self, file_id: str, filetype: str = 'bytes'):
         self.update_creds()
         f = self._gdrive.CreateFile({'id': file_id})
         f.FetchContent()
         if filetype == 'file':
-            content = f.content
-        elif filetype == 'bytes':
-            content = f.content.read()
-        else:
-            content = f.GetContentString()
-        f = None
-        return content
+            return f.content
+        if filetype == 'bytes':
+            return f.content.read()
+        return f.GetContentString()
+
+    async def download(self, file_id: str, filetype: str = 'bytes'):
+        return await self._run(self._download, file_id, filetype)
@@ -1,83 +1,395 @@
 import torch
 from PIL import Image
 from typing import Union, BinaryIO, Optional, List
-from lavis.models import load_model_and_preprocess
+from lavis.models import load_model_and_preprocess, load_preprocess
+from lavis.common.registry import registry
+from omegaconf import OmegaConf
 import os
+import re
+import asyncio
 import logging
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
-from translator import Translator
+from config import CONFIG
+from translator import get_translator
+from cache import Cache
+from metrics import timer, timed
+import inference_worker
 
 # ============================================================ # 
 # https://github.com/salesforce/LAVIS#image-captioning
 
 os.environ['HF_HUB_DISABLE_SYMLINKS_WARNING'] = 'true'
 
+CAPTION_MODEL = ('blip_caption', CONFIG.caption_model)
+VQA_MODEL = ('blip_vqa', 'vqav2')
+
+# ============================================================ #
+
+class ModelRegistry:
+    """Загружает модели LAVIS один раз на процесс и раздаёт общие ссылки на них."""
+
+    def __init__(self):
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self._models = {}
+        self._processors = {}
+        # загрузка модели идет десятки секунд: блокировки по моделям, чтобы не мешать другим моделям
+        # и препроцессорам (их запрашивает цикл событий)
+        self._locks: dict[tuple, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._proc_lock = threading.Lock()
+
+    def _lock(self, key: tuple) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, name: str, model_type: str) -> tuple:
+        key = (name, model_type)
+        with self._lock(key):
+            if not key in self._models:
+                logging.info(f'ModelRegistry: Загрузка модели {name}/{model_type} ...')
+                model, vis, txt = load_model_and_preprocess(name=name, model_type=model_type, is_eval=True, device=self.device)
+                if CONFIG.quantize and self.device.type == 'cpu':
+                    # динамическое int8-квантование линейных слоев: в разы быстрее на CPU ценой небольшой потери качества
+                    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                self._models[key] = model
+                with self._proc_lock:
+                    self._processors[key] = (vis, txt)
+                logging.info(f'ModelRegistry: Модель {name}/{model_type} загружена')
+            return (self._models[key],) + self.processors(name, model_type)
+
+    def processors(self, name: str, model_type: str) -> tuple:
+        # препроцессоры легкие: грузим их без весов модели
+        key = (name, model_type)
+        with self._proc_lock:
+            if not key in self._processors:
+                cfg = OmegaConf.load(registry.get_model_class(name).default_config_path(model_type))
+                self._processors[key] = load_preprocess(cfg.preprocess)
+            return self._processors[key]
+
+    def preload(self):
+        for model in (CAPTION_MODEL, VQA_MODEL):
+            self.get(*model)
+
+    def unload(self):
+        with self._locks_lock:
+            self._models.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+MODELS = ModelRegistry()
+
+# ============================================================ #
+# задачи инференса: выполняются в пуле воркеров, каждый процесс-воркер владеет своими моделями
+
+def configure_torch():
+    if CONFIG.torch_threads:
+        torch.set_num_threads(CONFIG.torch_threads)
+    if CONFIG.torch_interop_threads:
+        try:
+            torch.set_num_interop_threads(CONFIG.torch_interop_threads)
+        except RuntimeError as err:
+            # задать можно только до первой параллельной операции в процессе
+            logging.warning(err)
+
+def encode_images(model, items: List[torch.Tensor]) -> List[torch.Tensor]:
+    # на входе пиксели (1, 3, H, W) или уже посчитанные эмбеддинги ViT (1, N, D): 
+    # энкодер прогоняем только для пикселей, одним пакетом
+    pixels = [i for i, item in enumerate(items) if item.dim() == 4]
+    embeds = list(items)
+    if pixels:
+        encoded = model.visual_encoder.forward_features(torch.cat([items[i] for i in pixels]).to(MODELS.device))
+        for i, e in zip(pixels, encoded.split(1)):
+            # копия, а не срез: иначе каждый эмбеддинг держал бы в памяти весь тензор пакета
+            embeds[i] = e.clone()
+    return [e.to(MODELS.device) for e in embeds]
+
+def caption_job(items: List[torch.Tensor], numbers: List[int]) -> List[tuple]:
+    # то же, что BlipCaption.generate, но с готовыми эмбеддингами изображений;
+    # модель возвращает по `n` описаний подряд для каждого изображения пакета
+    model, _, _ = MODELS.get(*CAPTION_MODEL)
+    n = max(numbers)
+    with torch.inference_mode():
+        embeds = encode_images(model, items)
+        image_embeds = torch.repeat_interleave(torch.cat(embeds), n, 0)
+        prompt = model.tokenizer([model.prompt] * image_embeds.size(0), return_tensors='pt').to(MODELS.device)
+        prompt.input_ids[:, 0] = model.tokenizer.bos_token_id
+        prompt.input_ids = prompt.input_ids[:, :-1]
+        decoder_out = model.text_decoder.generate_from_encoder(
+            tokenized_prompt=prompt, visual_embeds=image_embeds, 
+            sep_token_id=model.tokenizer.sep_token_id, pad_token_id=model.tokenizer.pad_token_id,
+            use_nucleus_sampling=True, num_beams=3, max_length=30, min_length=10, top_p=0.9, repetition_penalty=1.0)
+        outputs = model.tokenizer.batch_decode(decoder_out, skip_special_tokens=True)
+    captions = [output[len(model.prompt):] for output in outputs]
+    return [(captions[i * n:i * n + number], embeds[i].cpu()) for i, number in enumerate(numbers)]
+
+def vqa_job(items: List[torch.Tensor], questions: List[str]) -> List[tuple]:
+    # то же, что BlipVQA.predict_answers(inference_method='generate'), но с готовыми эмбеддингами:
+    # для повторных вопросов к той же картинке работают только текстовые энкодер и декодер
+    model, _, txt_processors = MODELS.get(*VQA_MODEL)
+    num_beams = 3
+    with torch.inference_mode():
+        embeds = encode_images(model, items)
+        tokens = model.tokenizer([txt_processors['eval'](q) for q in questions], padding='longest', truncation=True, 
+                                 max_length=model.max_txt_len, return_tensors='pt').to(MODELS.device)
+        tokens.input_ids[:, 0] = model.tokenizer.enc_token_id
+        encoder_out = model.text_encoder.forward_automask(tokenized_text=tokens, visual_embeds=torch.cat(embeds))
+        question_states = encoder_out.last_hidden_state.repeat_interleave(num_beams, dim=0)
+        question_atts = torch.ones(question_states.size()[:-1], dtype=torch.long).to(MODELS.device)
+        bos_ids = torch.full((len(questions), 1), fill_value=model.tokenizer.bos_token_id, device=MODELS.device)
+        outputs = model.text_decoder.generate(
+            input_ids=bos_ids, max_length=10, min_length=1, num_beams=num_beams, 
+            eos_token_id=model.tokenizer.sep_token_id, pad_token_id=model.tokenizer.pad_token_id,
+            encoder_hidden_states=question_states, encoder_attention_mask=question_atts)
+    answers = [model.tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+    return [(answer, embeds[i].cpu()) for i, answer in enumerate(answers)]
+
+# ============================================================ #
+
+class InferenceBusyError(Exception):
+    pass
+
+class InferenceExecutor:
+    """Пул воркеров инференса (потоки или процессы) с ограниченной очередью задач."""
+
+    def __init__(self, workers: int = 1, kind: str = 'thread', max_queue: int = 8):
+        self._workers = max(workers, 1)
+        self._kind = kind
+        self._max_queue = max(max_queue, 0)
+        self._pending = 0
+        self._pool: Optional[Executor] = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def busy(self) -> bool:
+        return self._pending >= self._workers + self._max_queue
+
+    def start(self):
+        if not self._pool is None:
+            return
+        logging.info(f'InferenceExecutor: Запуск пула ({self._kind}, воркеров: {self._workers}) ...')
+        if self._kind == 'process':
+            inference_worker.use_as_main()
+            self._pool = ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=inference_worker.init_worker, initargs=(CONFIG.preload_models,))
+        else:
+            configure_torch()
+            self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix='inference')
+
+    def shutdown(self):
+        if not self._pool is None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            logging.info('InferenceExecutor: Пул остановлен')
+
+    async def submit(self, fn, *args, **kwargs):
+        if self.busy:
+            raise InferenceBusyError(f'Очередь инференса заполнена ({self._pending})')
+        self.start()
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+INFERENCE = InferenceExecutor(CONFIG.inference_workers, CONFIG.inference_pool, CONFIG.inference_queue)
+
+# ============================================================ #
+
+class InferenceBatcher:
+    """Собирает одновременные запросы из разных чатов в пакет и прогоняет его одним проходом модели."""
+
+    def __init__(self, job, executor: InferenceExecutor = INFERENCE, window: float = 0.2, max_batch: int = 8):
+        self._job = job
+        self._executor = executor
+        self._window = window
+        self._max_batch = max(max_batch, 1)
+        self._queue: List[tuple] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def submit(self, image: torch.Tensor, arg):
+        if self._executor.busy:
+            raise InferenceBusyError(f'Очередь инференса заполнена ({self._executor.pending})')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((image, arg, future))
+        if len(self._queue) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self):
+        if not self._timer is None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            batch, self._queue = self._queue[:self._max_batch], self._queue[self._max_batch:]
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[tuple]):
+        images, args, futures = zip(*batch)
+        logging.debug(f'InferenceBatcher: Пакет из {len(batch)} запросов ...')
+        try:
+            with timer(f'inference_{self._job.__name__}'):
+                results = await self._executor.submit(self._job, list(images), list(args))
+        except Exception as err:
+            for future in futures:
+                if not future.done(): future.set_exception(err)
+        else:
+            for future, result in zip(futures, results):
+                if not future.done(): future.set_result(result)
+
+# готовые (английские) описания и ответы по ключу изображения: {'captions': [...], 'answers': {вопрос: ответ}}
+RESULTS = Cache('results', CONFIG.cache_size, CONFIG.cache_ttl)
+
+def normalize_question(question: str) -> str:
+    return ' '.join(re.findall(r'\w+', question.lower()))
+
+CAPTION_BATCHER = InferenceBatcher(caption_job, window=CONFIG.batch_window, max_batch=CONFIG.batch_max)
+VQA_BATCHER = InferenceBatcher(vqa_job, window=CONFIG.batch_window, max_batch=CONFIG.batch_max)
+
 # ============================================================ #
 
 class Imgcap:
 
-    def __init__(self, source_image: Optional[Union[str, bytes, BinaryIO]]):
+    def __init__(self, source_image: Optional[Union[str, bytes, BinaryIO]], key: Optional[str] = None):
         logging.debug('Imgcap: Инициализация объекта ...')
-        self.image = None        
-        self._device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        cap = load_model_and_preprocess(name='blip_caption', model_type='large_coco', is_eval=True, device=self._device)
-        vqa = load_model_and_preprocess(name='blip_vqa', model_type='vqav2', is_eval=True, device=self._device)        
-        self._cap_model = cap[0]
-        self._cap_vis_processors = cap[1]
-        self._cap_txt_processors = cap[2]
-        self._vqa_model = vqa[0]
-        self._vqa_vis_processors = vqa[1]
-        self._vqa_txt_processors = vqa[2]
+        self.image = None
+        self.key = key
         self.load(source_image)
         logging.debug('Imgcap: Объект создан')
 
+    @classmethod
+    async def open(cls, source_image: Optional[Union[str, bytes, BinaryIO]], key: Optional[str] = None) -> 'Imgcap':
+        # декодирование картинки нагружает CPU: уводим его из цикла событий
+        imcap = cls(None, key)
+        await asyncio.get_running_loop().run_in_executor(None, imcap.load, source_image)
+        return imcap
+
     def __del__(self):
         if not self.image is None:
             self.image.close()
         logging.debug('Imgcap: Объект уничтожен')
 
+    @timed('imgcap_load')
     def load(self, img: Optional[Union[str, bytes, BinaryIO]]):
         if not self.image is None:
             self.image.close()
+        # пиксели (после препроцессора) и эмбеддинги ViT по моделям; все тензоры на CPU, на устройство их переносит воркер
+        self._pixels = {}
+        self._embeds = {}
         if not img is None: 
             logging.debug('Imgcap: Загрузка нового изображения ...')
             self.image = Image.open(img).convert('RGB')
-            self._cap_image = self._cap_vis_processors['eval'](self.image).unsqueeze(0).to(self._device)
-            self._vqa_image = self._vqa_vis_processors['eval'](self.image).unsqueeze(0).to(self._device)
             logging.debug('Imgcap: Изображение загружено в память')
 
-    async def translate(self, texts: Union[str, List[str]], 
+    def _preprocess(self, model: tuple) -> torch.Tensor:
+        if not model in self._pixels:
+            processor = MODELS.processors(*model)[0]['eval']
+            # одинаковые препроцессоры (тот же размер и нормализация) считаем один раз
+            same = [m for m in self._pixels if repr(getattr(MODELS.processors(*m)[0]['eval'], 'transform', m)) == 
+                                               repr(getattr(processor, 'transform', model))]
+            if same:
+                self._pixels[model] = self._pixels[same[0]]
+            else:
+                with timer('imgcap_preprocess'):
+                    self._pixels[model] = processor(self.image).unsqueeze(0)
+        return self._pixels[model]
+
+    async def _input(self, model: tuple) -> torch.Tensor:
+        # эмбеддинги уже посчитаны — энкодер изображения повторно не нужен
+        if model in self._embeds:
+            return self._embeds[model]
+        # препроцессор (и первая загрузка его конфига) - вне цикла событий
+        return await asyncio.get_running_loop().run_in_executor(None, self._preprocess, model)
+
+    async def _infer(self, batcher: 'InferenceBatcher', model: tuple, arg):
+        result, self._embeds[model] = await batcher.submit(await self._input(model), arg)
+        # пиксели этой модели больше не понадобятся, а с эмбеддингами обеих моделей - и сама картинка
+        self._pixels.pop(model, None)
+        if not self.image is None and all(m in self._embeds for m in (CAPTION_MODEL, VQA_MODEL)):
+            self.image.close()
+            self.image = None
+        return result
+
+    @staticmethod
+    async def translate(texts: Union[str, List[str]], 
                         fromlang: Optional[str] = 'en', tolang: Optional[str] = 'ru') -> List[str]:
-        async with Translator() as tr:
+        async with get_translator() as tr:
             results = await tr.translate(texts, tolang or 'ru', fromlang)
         return results
     
-    def capitalize(self, results: Union[str, List[str]]) -> List[str]:
+    @staticmethod
+    def capitalize(results: Union[str, List[str]]) -> List[str]:
         if isinstance(results, str):
             results = [results]
         return [s.capitalize() for s in results]
 
+    @staticmethod
+    async def cached_summary(key: Optional[str], number: int = 1) -> Optional[List[str]]:
+        if not key: return None
+        record = await RESULTS.get(key, {})
+        captions = record.get('captions', [])
+        if len(captions) < number: return None
+        logging.info(f'Imgcap: Описания найдены в кэше: {repr(captions[:number])}')
+        return Imgcap.capitalize(await Imgcap.translate(captions[:number]))
+
+    @staticmethod
+    async def cached_answer(key: Optional[str], question: str, lang: Optional[str] = None) -> Optional[str]:
+        if not key: return None
+        record = await RESULTS.get(key, {})
+        res = record.get('answers', {}).get(normalize_question(question), None)
+        if res is None: return None
+        logging.info(f'Imgcap: Ответ на вопрос "{question}" найден в кэше: "{res}"')
+        results = Imgcap.capitalize(await Imgcap.translate(res))
+        return results[0] if results else ''
+
+    @property
+    def nbytes(self) -> int:
+        tensors = {id(t): t for t in list(self._pixels.values()) + list(self._embeds.values())}
+        image = self.image.width * self.image.height * len(self.image.getbands()) if self.image else 0
+        return image + sum(t.element_size() * t.nelement() for t in tensors.values())
+
+    async def _store(self, captions: Optional[List[str]] = None, question: Optional[str] = None, answer: Optional[str] = None):
+        if not self.key: return
+        record = await RESULTS.get(self.key, {})
+        if captions:
+            record['captions'] = captions
+        if question and answer:
+            record.setdefault('answers', {})[normalize_question(question)] = answer
+        await RESULTS.set(self.key, record)
+
     async def summary(self, number: int = 1) -> List[str]:
         logging.info('Imgcap: Генерация описания для изображения ...')
-        results = self._cap_model.generate({'image': self._cap_image}, use_nucleus_sampling=True, num_captions=number)
+        results = await self._infer(CAPTION_BATCHER, CAPTION_MODEL, number)
         logging.info(f'Imgcap: Описания сгенерированы: {repr(results)}')
+        await self._store(captions=results)
         results = await self.translate(results)
         results = self.capitalize(results)
         logging.info(f'Imgcap: Описания переведены: {repr(results)}')
         return results
     
     async def answer(self, question: str, lang: Optional[str] = None) -> str:
+        original = question
         if not lang is None and lang != 'en':
             logging.info(f'Imgcap: Перевод вопроса "{question}" ...')
             question = await self.translate(question, lang, 'en')
             question = question[0]
             logging.info(f'Imgcap: Вопрос переведен: "{question}"')
         logging.info(f'Imgcap: Генерация ответа на вопрос "{question}" ...')
-        q = self._vqa_txt_processors['eval'](question)
-        samples = {'image': self._vqa_image, 'text_input': q}
-        reply = self._vqa_model.predict_answers(samples=samples, inference_method='generate')
-        res = reply[0] if reply else ''
+        res = await self._infer(VQA_BATCHER, VQA_MODEL, question)
         logging.info(f'Imgcap: Ответ на вопрос "{question}" сгенерирован: "{res}"')
+        await self._store(question=original, answer=res)
         results = await self.translate(res)
         logging.info(f'Imgcap: Ответ переведен: {repr(results)}')
         results = self.capitalize(results)
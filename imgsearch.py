@@ -1,14 +1,20 @@
-from google_images_search import GoogleImagesSearch
 from io import BytesIO
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Optional, AsyncIterator
+import time
+import asyncio
 import logging
 import mimetypes
+import httpx
 
 from config import CONFIG
+from requestor import exec_method, POOL, HEADERS
+from cache import LRUCache, DiskCache
+from metrics import timer, timed, observe
 
 # ============================================================ #
-# https://github.com/arrrlo/Google-Images-Search
+# https://developers.google.com/custom-search/v1/reference/rest/v1/cse/list
 # _search_params = {
 #     'q': '...',
 #     'num': 10,
@@ -31,6 +37,12 @@ OPT_COLORTYPE = 'imgColorTypeUndefined'
 DEFAULT_NUMBER = 10
 MAX_NUMBER = 50
 MAX_IMGSIZE = 800
+MAX_IMGBYTES = 512 * 1024
+JPEG_QUALITY = (85, 75, 60, 45)
+SEARCH_URL = 'https://www.googleapis.com/customsearch/v1'
+PAGE_SIZE = 10              # максимум результатов на один запрос к API
+MAX_DOWNLOADS = 10          # одновременных загрузок картинок
+DOWNLOAD_TIMEOUT = 15.0     # сек. на загрузку одной картинки
 
 mimetypes.init()
 
@@ -40,55 +52,208 @@ class SimpleImage(BaseModel):
     img: bytes
     mime: str
     filename: str
+    timings: dict[str, float] = {}
 
     def __str__(self):
         return f'{self.filename} ({self.mime}) - {len(self.img)} b'
 
+class SearchEntry(BaseModel):
+    urls: list[str] = []                    # ссылки в порядке выдачи поиска
+    images: dict[str, SimpleImage] = {}     # уже обработанные картинки по ссылке
+    exhausted: bool = False                 # поиск вернул меньше, чем просили: дальше страниц нет
+    created: float = Field(default_factory=time.time)   # от него отсчитывается время жизни в кэше
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(res_img.img) for res_img in self.images.values())
+
+class SearchCache:
+    """Кэш выдачи поиска по запросу и фильтрам: LRU в памяти с лимитом объема и (опционально) каталог на диске."""
+
+    def __init__(self, ttl: int = 3600, maxbytes: Optional[int] = None, path: Optional[str] = None):
+        self.memory = LRUCache(1024, ttl, maxbytes, lambda entry: entry.nbytes)
+        self.disk = DiskCache(path, ttl, maxbytes) if path else None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(params: dict, max_dimension: int) -> str:
+        params = params | {'q': ' '.join(params['q'].lower().split()), 'max_dimension': max_dimension}
+        return '&'.join(f'{k}={v}' for k, v in sorted(params.items()) if v)
+
+    async def get(self, key: str) -> Optional[SearchEntry]:
+        entry = self.memory.get(key)
+        if entry is None and not self.disk is None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if not entry is None:
+                self.memory.set(key, entry)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, entry: SearchEntry):
+        # дозапись не продлевает жизнь записи: ссылки из выдачи устаревают независимо от популярности запроса
+        ttl = self.memory.ttl - (time.time() - entry.created) if self.memory.ttl else None
+        if not ttl is None and ttl <= 0:
+            self.memory.pop(key)
+            return
+        self.memory.set(key, entry, ttl)
+        if not self.disk is None:
+            try:
+                await asyncio.to_thread(self.disk.set, key, entry, entry.created)
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+
+SEARCH_CACHE = SearchCache(CONFIG.search_cache_ttl, CONFIG.search_cache_bytes, CONFIG.search_cache_dir)
+
 # ============================================================ #
 
-def resize_img(img: Image, max_dimension: int) -> Image:
-    w, h = img.size
-    res_ratio = min(max_dimension/w, max_dimension/h)
-    new_size = tuple(round(x * res_ratio) for x in (w, h))
-    return img.resize(new_size) if res_ratio < 1.0 else img
+def _flatten(img: Image.Image) -> Image.Image:
+    # прозрачность кладем на белый фон
+    background = Image.new('RGB', img.size, 'white')
+    background.paste(img, mask=img.getchannel('A'))
+    return background
+
+def _encode(img: Image.Image, fmt: str, **params) -> bytes:
+    with BytesIO() as out:
+        img.save(out, fmt, **params)
+        return out.getvalue()
+
+def transcode(content: bytes, max_dimension: int = MAX_IMGSIZE, max_bytes: int = MAX_IMGBYTES) -> tuple[bytes, str, dict]:
+    """Уменьшает картинку до `max_dimension` и перекодирует ее для Telegram.
+    Возвращает (байты, формат PIL, замеры времени этапов в сек.)."""
+    timings = {}
+    t = time.perf_counter()
+    with Image.open(BytesIO(content)) as img:
+        fmt = img.format
+        if fmt == 'JPEG':
+            # JPEG умеет декодироваться сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+            img.draft('RGB', (max_dimension, max_dimension))
+        if getattr(img, 'is_animated', False):
+            # Telegram все равно покажет фото статичным: берем первый кадр
+            img.seek(0)
+        img.load()
+        timings['decode'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            if fmt != 'PNG':
+                # прозрачность сохраняем только у PNG
+                img = _flatten(img)
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=3.0)
+        timings['resize'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        data = None
+        if fmt == 'PNG':
+            data = _encode(img, 'PNG', optimize=False)
+            if len(data) > max_bytes:
+                # большие PNG (обычно фото) переводим в JPEG
+                data = None
+                if img.mode == 'RGBA':
+                    img = _flatten(img)
+        if data is None:
+            fmt = 'JPEG'
+            for quality in JPEG_QUALITY:
+                data = _encode(img, fmt, quality=quality, optimize=True)
+                if len(data) <= max_bytes: break
+        timings['encode'] = time.perf_counter() - t
+    return data, fmt, timings
 
 # ============================================================ #
 
-def search(q: str, num: int = DEFAULT_NUMBER, fileType: str = OPT_FILETYPE, rights: str = OPT_RIGHTS,
-           safe: str = OPT_SAFE, imgType: str = OPT_IMGTYPE, imgSize: str = OPT_IMGSIZE, 
-           imgDominantColor: str = OPT_COLOR, imgColorType: str = OPT_COLORTYPE, 
-           max_dimension: int = MAX_IMGSIZE) -> list[SimpleImage]:
-    if num < 1: return []
-    params = {'q': q, 'num': min(num, MAX_NUMBER), 'fileType': fileType, 'rights': rights, 
-              'safe': safe, 'imgType': imgType, 'imgSize': imgSize, 
-              'imgDominantColor': imgDominantColor, 'imgColorType': imgColorType}
-    logging.info('Поиск изображений:\n' + repr(params))
+async def _search_page(client: httpx.AsyncClient, params: dict, start: int, num: int) -> Optional[list[str]]:
+    page = params | {'start': start, 'num': num}
+    res = await exec_method(SEARCH_URL, 'GET', SEARCH_URL, client, params=page)
+    if res is None: return None
+    return [item['link'] for item in res.get('items', []) if item.get('link')]
+
+@timed('google_search')
+async def search_urls(client: httpx.AsyncClient, params: dict, num: int, offset: int = 0) -> tuple[list[str], bool]:
+    """Возвращает `num` ссылок начиная с позиции `offset` и признак того, что выдача закончилась."""
+    pages = [_search_page(client, params, offset + start + 1, min(PAGE_SIZE, num - start)) for start in range(0, num, PAGE_SIZE)]
+    results = await asyncio.gather(*pages)
+    urls = [url for page in results if page for url in page][:num]
+    return urls, (len(urls) < num and not None in results)
+
+def process_image(i: int, content: bytes, max_dimension: int) -> SimpleImage:
+    data, mime, timings = transcode(content, max_dimension)
+    for stage, dt in timings.items():
+        observe(f'image_{stage}', dt)
+    ext = mimetypes.guess_extension(Image.MIME[mime], False)
+    logging.debug(f'Изображение [{i}]: {len(content)} b -> {len(data)} b, ' + 
+                  ', '.join(f'{stage} {dt * 1000:.1f} мс' for stage, dt in timings.items()))
+    return SimpleImage(img=data, mime=mime, filename=f'{i:02}{ext}', timings=timings)
+
+async def fetch_image(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, 
+                      i: int, url: str, max_dimension: int) -> Optional[SimpleImage]:
+    logging.debug(f'Обработка изображения [{i}]: {url} ...') 
     try:
-        gis = GoogleImagesSearch(CONFIG.google_api_key.get_secret_value(), CONFIG.google_cx.get_secret_value())
-        gis.search(params)
+        async with semaphore:
+            with timer('image_download'):
+                r = await asyncio.wait_for(client.get(url), DOWNLOAD_TIMEOUT)
+            r.raise_for_status()
+        # декодирование и масштабирование нагружают CPU: уводим их из цикла событий
+        res_img = await asyncio.get_running_loop().run_in_executor(None, process_image, i, r.content, max_dimension)
     except Exception as err:
         logging.exception(err, exc_info=False)
-        return []
-    else:
-        results = []
-        for i, image in enumerate(gis.results()):
-            logging.debug(f'Обработка изображения [{i}]: {image.url} ...') 
-            my_bytes_io = BytesIO()
-            try:                            
-                image.copy_to(my_bytes_io)
-                my_bytes_io.seek(0)
-                img = Image.open(my_bytes_io)
-                mime = img.format
-                ext = mimetypes.guess_extension(Image.MIME[mime], False)
-                img = resize_img(img, max_dimension)
-                my_bytes_io.seek(0)
-                img.save(my_bytes_io, mime)
-                res_img = SimpleImage(img=my_bytes_io.getvalue(), mime=mime, filename=f'{i:02}{ext}')
-                logging.debug(str(res_img))
-                results.append(res_img)
-                logging.debug(f'Изображение [{i}] СОХРАНЕНО')
-            except Exception as err:
-                logging.exception(err)                
-            finally:
-                my_bytes_io.close()
-        return results
\ No newline at end of file
+        return None
+    logging.debug(f'Изображение [{i}] СОХРАНЕНО: {str(res_img)}')
+    return res_img
+
+async def search_iter(q: str, num: int = DEFAULT_NUMBER, fileType: str = OPT_FILETYPE, rights: str = OPT_RIGHTS,
+                      safe: str = OPT_SAFE, imgType: str = OPT_IMGTYPE, imgSize: str = OPT_IMGSIZE, 
+                      imgDominantColor: str = OPT_COLOR, imgColorType: str = OPT_COLORTYPE, 
+                      max_dimension: int = MAX_IMGSIZE) -> AsyncIterator[SimpleImage]:
+    """Отдает картинки по мере готовности (а не в порядке выдачи поиска)."""
+    if num < 1: return
+    num = min(num, MAX_NUMBER)
+    params = {'q': q, 'searchType': 'image', 'fileType': fileType, 'rights': rights, 
+              'safe': safe, 'imgType': imgType, 'imgSize': imgSize, 
+              'imgDominantColor': imgDominantColor, 'imgColorType': imgColorType}
+    logging.info('Поиск изображений:\n' + repr(params | {'num': num}))
+    params = {k: v for k, v in params.items() if v}
+    key = SearchCache.make_key(params, max_dimension)
+    entry = await SEARCH_CACHE.get(key) or SearchEntry()
+    state = (len(entry.urls), len(entry.images), entry.exhausted)
+    params |= {'cx': CONFIG.google_cx.get_secret_value()}
+    # ключ API передаем заголовком, а не в строке запроса: URL запроса попадает в лог
+    search_client = POOL.get(SEARCH_URL, dict(HEADERS) | {'x-goog-api-key': CONFIG.google_api_key.get_secret_value()})
+    client = POOL.get()
+    # в кэше может быть только начало выдачи: догружаем недостающие страницы
+    if len(entry.urls) < num and not entry.exhausted:
+        urls, entry.exhausted = await search_urls(search_client, params, num - len(entry.urls), len(entry.urls))
+        entry.urls += [url for url in urls if not url in entry.urls]
+    urls = entry.urls[:num]
+    for url in urls:
+        if url in entry.images:
+            yield entry.images[url]
+    semaphore = asyncio.Semaphore(MAX_DOWNLOADS)
+
+    async def fetch(i: int, url: str) -> Optional[SimpleImage]:
+        res_img = await fetch_image(client, semaphore, i, url, max_dimension)
+        if not res_img is None:
+            entry.images[url] = res_img
+        return res_img
+
+    tasks = [asyncio.create_task(fetch(i, url)) for i, url in enumerate(urls) if not url in entry.images]
+    try:
+        for task in asyncio.as_completed(tasks):
+            res_img = await task
+            if not res_img is None: 
+                yield res_img
+    finally:
+        # потребитель мог прервать перебор: незавершенные загрузки больше не нужны
+        for task in tasks:
+            task.cancel()
+        # запись из кэша, к которой ничего не добавилось, не перезаписываем
+        if (len(entry.urls), len(entry.images), entry.exhausted) != state:
+            await SEARCH_CACHE.set(key, entry)
+
+async def search(q: str, num: int = DEFAULT_NUMBER, **kwargs) -> list[SimpleImage]:
+    return [res_img async for res_img in search_iter(q, num, **kwargs)]
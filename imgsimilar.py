@@ -1,18 +1,95 @@
-from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 from pydantic import BaseModel
 from typing import Optional, List, Union
+from urllib.parse import parse_qsl
+from pathlib import Path
+from io import BytesIO
+from PIL import Image
+from aiohttp import web
+import time
+import asyncio
+import httpx
 import logging
 
-from requestor import AsyncRequestor
+from config import CONFIG
+from requestor import AsyncRequestor, serialize
 from gdrive import Gdrive
+from cache import Cache
+from metrics import timer, timed
 
 #==============================================================================#
 
 BASE_URL = 'https://yandex.ru/images/search'
 MAX_SIMILAR = 20
+HASH_BITS = 64               # длина dHash
+BUCKET_SIZE = 256            # хэшей в одной корзине LSH (в Redis), старые вытесняются
 NL = '\n'
 DRIVE = Gdrive()
 
+def _xpath_class(tag: str, *classes: str) -> str:
+    return tag + ''.join(f"[contains(concat(' ', normalize-space(@class), ' '), ' {c} ')]" for c in classes)
+
+# XPath компилируются один раз
+XP_PREVIEW = etree.XPath(f"({_xpath_class('//img', 'CbirPreview-Image')})[1]/@src")
+XP_TITLE = etree.XPath(f"({_xpath_class('//h2', 'CbirObjectResponse-Title')})[1]")
+XP_SUBTITLE = etree.XPath(f"({_xpath_class('//div', 'CbirObjectResponse-Description')})[1]")
+XP_TAGS = etree.XPath(f"({_xpath_class('//div', 'Tags', 'Tags_type_expandable', 'Tags_view_buttons')})[1]"
+                      f"{_xpath_class('//span', 'Button2-Text')}")
+XP_THUMBS = etree.XPath(f"({_xpath_class('//div', 'CbirSimilar-Thumbs')})[1]"
+                        f"{_xpath_class('//div', 'MMImage', 'MMImage_type_cover', 'Thumb-Image')}/@style")
+UPLOAD_REQUEST = serialize({'blocks': [{'block': 'b-page_type_search-by-image__link'}]})
+LOCAL_TTL = 120             # сек. жизни ссылки на картинку в локальном HTTP-сервере
+
+#==============================================================================#
+
+class LocalImageServer:
+    """Короткоживущие ссылки на картинки, которые Яндекс забирает прямо с бота (без Google Drive)."""
+
+    def __init__(self, host: str, port: int, public_url: Optional[str]):
+        self._host = host
+        self._port = port
+        self._public_url = (public_url or f'http://{host}:{port}').rstrip('/')
+        self._images: dict[str, tuple[bytes, str]] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        image = self._images.get(request.match_info['token'], None)
+        if image is None:
+            raise web.HTTPNotFound()
+        content, mime = image
+        return web.Response(body=content, content_type=mime)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/img/{token}', self._handle)
+        return app
+
+    async def start(self):
+        if not self._runner is None: return
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        logging.info(f'LocalImageServer: Запущен на {self._host}:{self._port}')
+
+    async def stop(self):
+        if not self._runner is None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def publish(self, content: bytes) -> tuple[str, str]:
+        await self.start()
+        token = Gdrive.generate_uid()
+        # отдаем настоящий тип картинки (PNG, WebP, GIF), а не всегда JPEG
+        self._images[token] = (content, Gdrive.sniff_mime(content) or 'application/octet-stream')
+        asyncio.get_running_loop().call_later(LOCAL_TTL, self._images.pop, token, None)
+        return token, f'{self._public_url}/img/{token}'
+
+    def unpublish(self, token: str):
+        self._images.pop(token, None)
+
+LOCAL_SERVER = LocalImageServer(CONFIG.similar_local_host, CONFIG.similar_local_port, CONFIG.similar_public_url)
+
 #==============================================================================#
 
 class SimilarResult(BaseModel):
@@ -27,63 +104,189 @@ class SimilarResult(BaseModel):
 
 #==============================================================================#
 
+def dhash(content: bytes, size: int = 8) -> int:
+    """Разностный перцептивный хэш (64 бита): устойчив к пересжатию и масштабированию."""
+    with Image.open(BytesIO(content)) as img:
+        img.draft('L', (size * 8, size * 8))
+        pixels = list(img.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left, right = pixels[row * (size + 1) + col], pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+class SimilarCache(Cache):
+    """Результаты поиска похожих по dHash картинки. Находит и почти-дубликаты: 
+    хэши, отличающиеся не более чем на `distance` бит. В Redis хэши живых записей 
+    разложены по корзинам LSH: 64 бита делятся на `distance + 1` полос, и хэш попадает в корзину 
+    каждой своей полосы (sorted set, score = время истечения). У хэшей на расстоянии не больше 
+    `distance` хотя бы одна полоса совпадает целиком, поэтому при поиске достаточно прочитать 
+    `distance + 1` корзин, а не весь индекс."""
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 86400, distance: int = 6, redis=None,
+                 bucket_size: int = BUCKET_SIZE):
+        super().__init__('similar', maxsize, ttl, redis)
+        self.distance = distance
+        self.bucket_size = bucket_size
+        n = min(distance + 1, HASH_BITS)
+        self._bands = [(HASH_BITS * i // n, HASH_BITS * (i + 1) // n) for i in range(n)]
+
+    def _buckets(self, h: int) -> list[str]:
+        return [self._redis_key(f'band:{i}:{(h >> lo) & ((1 << (hi - lo)) - 1):x}') for i, (lo, hi) in enumerate(self._bands)]
+
+    async def _hashes(self, h: int) -> set[str]:
+        hashes = set(self.memory.keys())
+        if not self.redis is None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for bucket in self._buckets(h):
+                        pipe.zrangebyscore(bucket, time.time(), '+inf')
+                    for found in await pipe.execute():
+                        hashes.update(k.decode() if isinstance(k, bytes) else k for k in found)
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+        return hashes
+
+    async def find(self, h: int) -> Optional[SimilarResult]:
+        best, best_distance = None, self.distance + 1
+        for key in await self._hashes(h):
+            d = (int(key, 16) ^ h).bit_count()
+            if d < best_distance:
+                best, best_distance = key, d
+        if best is None:
+            self.misses += 1
+            return None
+        res = await self.get(best)
+        return None if res is None else SimilarResult(**res)
+
+    async def add(self, h: int, result: SimilarResult):
+        key = f'{h:016x}'
+        await self.set(key, result.model_dump())
+        if not self.redis is None:
+            now = time.time()
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for bucket in self._buckets(h):
+                        pipe.zadd(bucket, {key: now + self.ttl})
+                        # корзина не растет без предела: истекшие и самые старые хэши вытесняются
+                        pipe.zremrangebyscore(bucket, '-inf', now)
+                        pipe.zremrangebyrank(bucket, 0, -self.bucket_size - 1)
+                        pipe.expire(bucket, self.ttl)
+                    await pipe.execute()
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+
+CACHE = SimilarCache(CONFIG.similar_cache_size, CONFIG.similar_cache_ttl, CONFIG.similar_hash_distance)
+
+#==============================================================================#
+
 class Imgsimilar(AsyncRequestor):
 
-    def __init__(self, max_similar: int = MAX_SIMILAR):
-        super().__init__(BASE_URL)
+    def __init__(self, max_similar: int = MAX_SIMILAR, client: httpx.AsyncClient = None):
+        super().__init__(BASE_URL, client)
         self._max_similar = max_similar or MAX_SIMILAR
 
+    @timed('yandex_fetch')
     async def _get_url(self, url: str) -> str:
         logging.debug(f'Imgsimilar: Загрузка страницы "{url}" ...')
         return await self.exec_get('', {'source': 'collections', 'rpt': 'imageview', 'url': url}, True)
 
-    def _parse_result(self, html: str) -> SimilarResult:
-        logging.debug('Imgsimilar: Парсинг HTML ...')
-        soup = BeautifulSoup(html, 'lxml')
-
-        url = soup.find('img', class_='CbirPreview-Image')
-        if url: 
-            url = url.get('src')
-
-        title = soup.find('h2', class_='CbirObjectResponse-Title')
+    def _make_result(self, url: Optional[str], title: Optional[str], subtitle: Optional[str], 
+                     tags: List[str], styles: List[str], page_url: Optional[str]) -> SimilarResult:
         if title: 
-            title = title.text.capitalize().strip('. ')
-
-        subtitle = soup.find('div', class_='CbirObjectResponse-Description')
+            title = title.capitalize().strip('. ')
         if subtitle: 
-            subtitle = subtitle.text.capitalize().strip('. ')
-
-        tags_div = soup.find('div', class_='Tags Tags_type_expandable Tags_view_buttons')
-        tags = []
-        if tags_div:
-            tags_ = tags_div.find_all('span', class_='Button2-Text')
-            if tags_:
-                tags = [t.text.capitalize() for t in tags_]
-
-        thumbs_div = soup.find('div', class_='CbirSimilar-Thumbs')
+            subtitle = subtitle.capitalize().strip('. ')
+        tags = [t.capitalize() for t in tags]
         similar = []
-        if thumbs_div:            
-            similar_ = thumbs_div.find_all('div', class_='MMImage MMImage_type_cover Thumb-Image')
-            if similar_:
-                for s in similar_:
-                    ss = s.get('style')
-                    if ':url(' in ss: similar.append('https:' + ss.split('(')[1][:-1])
+        for ss in styles:
+            if ss and ':url(' in ss: similar.append('https:' + ss.split('(')[1][:-1])
         if similar: similar = similar[:self._max_similar]
+        if page_url is None and url:
+            page_url = f'{BASE_URL}?source=collections&rpt=imageview&url={url}'
+        return SimilarResult(title=title, subtitle=subtitle, tags=tags, similar=similar, url=page_url)
+
+    @timed('yandex_parse')
+    def _parse_result(self, html: str, page_url: Optional[str] = None) -> SimilarResult:
+        logging.debug('Imgsimilar: Парсинг HTML ...')
+        if not html:
+            return self._make_result(None, None, None, [], [], page_url)
+        root = lxml.html.fromstring(html)
+        url = XP_PREVIEW(root)
+        title = XP_TITLE(root)
+        subtitle = XP_SUBTITLE(root)
+        res = self._make_result(url[0] if url else None, title[0].text_content() if title else None, 
+                                subtitle[0].text_content() if subtitle else None,
+                                [t.text_content() for t in XP_TAGS(root)], XP_THUMBS(root), page_url)
         logging.debug('Imgsimilar: Парсинг завершен')
-        return SimilarResult(title=title, subtitle=subtitle, tags=tags, similar=similar, 
-                             url=f'{BASE_URL}?source=collections&rpt=imageview&url={url}' if url else None)
+        return res
+
+    async def _parse(self, html: str, page_url: Optional[str] = None) -> SimilarResult:
+        # разбор большой страницы нагружает CPU: уводим его из цикла событий
+        return await asyncio.get_running_loop().run_in_executor(None, self._parse_result, html, page_url)
     
     async def parse(self, url: str) -> SimilarResult:
         html = await self._get_url(url)
-        return self._parse_result(html)
+        return await self._parse(html)
     
+    async def post_and_parse(self, content: bytes) -> SimilarResult:
+        # картинка отправляется прямо в Яндекс (multipart), в ответ приходит адрес страницы выдачи
+        logging.debug('Imgsimilar: Отправляю картинку в Яндекс ...')
+        with timer('yandex_upload'):
+            mime = Gdrive.sniff_mime(content) or 'image/jpeg'
+            res = await self.exec_post('', params={'rpt': 'imageview', 'format': 'json', 'request': UPLOAD_REQUEST}, 
+                                       files={'upfile': ('image' + Gdrive.get_mime_ext(mime), content, mime)})
+        try:
+            query = res['blocks'][0]['params']['url']
+        except (TypeError, KeyError, IndexError):
+            raise ValueError(f'Яндекс не вернул адрес страницы выдачи: {res!r:.200}') from None
+        logging.debug(f'Imgsimilar: Загрузка страницы "{query}" ...')
+        with timer('yandex_fetch'):
+            html = await self.exec_get('', dict(parse_qsl(query)), True)
+        return await self._parse(html, f'{BASE_URL}?{query}')
+
     async def upload_and_parse(self, file: Union[str, bytes]) -> SimilarResult:
+        if isinstance(file, str):
+            if file.lower().startswith('http'):
+                # по ссылке Яндекс заберет картинку сам
+                return await self.parse(file)
+            file = Path(file).read_bytes()
+
+        try:
+            h = await asyncio.get_running_loop().run_in_executor(None, dhash, file)
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+            h = None
+        if not h is None:
+            res = await CACHE.find(h)
+            if not res is None:
+                logging.debug('Imgsimilar: Результат найден в кэше')
+                return res
+        res = await self._upload_and_parse(file)
+        if not h is None and (res.url or res.similar):
+            await CACHE.add(h, res)
+        return res
+
+    async def _upload_and_parse(self, file: bytes) -> SimilarResult:
+        mode = CONFIG.similar_upload
+        if mode == 'direct':
+            return await self.post_and_parse(file)
+        if mode == 'local':
+            token, url = await LOCAL_SERVER.publish(file)
+            try:
+                return await self.parse(url)
+            finally:
+                LOCAL_SERVER.unpublish(token)
+
         logging.debug('Imgsimilar: Загружаю картинку в Google Drive ...')
-        gfile = await DRIVE.upload(file)
+        gfile = await DRIVE.upload(file, temporary=True)
         logging.debug(f'Imgsimilar: Загружено в Google Drive: {str(gfile)}')        
-        res = await self.parse(gfile.url)
-        await DRIVE.delete(gfile.id)
-        return res
+        try:
+            return await self.parse(gfile.url)
+        finally:
+            # пользователь не ждет удаления: оно идет в фоне с повторами
+            DRIVE.schedule_delete(gfile.id)
     
 # ============================================================ #
 
@@ -0,0 +1,20 @@
+import sys
+import importlib.util
+
+# ============================================================ #
+# Точка входа процессов пула инференса (`inference_pool=process`). При запуске через spawn дочерний
+# процесс заново импортирует главный модуль родителя; если это botmain.py или worker.py, в каждом воркере
+# создавались бы бот, диспетчер и хранилище FSM. Поэтому на время работы пула главным модулем
+# для дочерних процессов объявляется этот легкий модуль: он не импортирует ничего, кроме модели.
+
+# ============================================================ #
+
+def use_as_main():
+    """Вызывается в родителе перед созданием пула: spawn импортирует в воркерах этот модуль вместо главного."""
+    sys.modules['__main__'].__spec__ = importlib.util.find_spec(__name__)
+
+def init_worker(preload: bool):
+    import imgcap
+    imgcap.configure_torch()
+    if preload:
+        imgcap.MODELS.preload()
@@ -0,0 +1,139 @@
+import time
+import uuid
+import logging
+from pydantic import BaseModel, Field
+from typing import Optional
+
+#==============================================================================#
+# Очередь тяжелых задач в Redis: бот (фронтенд) кладет задачи, воркеры на любых узлах их забирают.
+#   pending    - ZSET готовых задач, score = приоритет * 1e13 + время постановки (мс)
+#   processing - ZSET взятых задач, score = крайний срок (visibility timeout)
+#   delayed    - ZSET отложенных повторов, score = время, когда задачу можно снова брать
+#   data       - HASH id -> JSON задачи
+#   timeouts   - HASH id -> visibility timeout, сек. (нужен скрипту взятия задачи)
+#   dead       - LIST задач, исчерпавших попытки
+
+PREFIX = 'imagebot:jobs:'
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+MAX_ATTEMPTS = 3
+
+# атомарно: взять задачу с наименьшим score и пометить ее как выполняемую до крайнего срока
+CLAIM_SCRIPT = """
+local item = redis.call('ZPOPMIN', KEYS[1])
+if #item == 0 then return false end
+local timeout = tonumber(redis.call('HGET', KEYS[3], item[1]) or ARGV[2])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + timeout, item[1])
+return item[1]
+"""
+
+#==============================================================================#
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    kind: str                       # caption | vqa | similar | search
+    chat_id: int
+    payload: dict = {}
+    priority: int = PRIORITY_NORMAL
+    timeout: int = 300              # сек., после которых невыполненная задача возвращается в очередь
+    attempts: int = 0
+
+    def __str__(self):
+        return f'{self.kind} [{self.id}] для чата {self.chat_id} (попытка {self.attempts + 1})'
+
+#==============================================================================#
+
+class JobQueue:
+    """Надежная очередь с приоритетами, таймаутом видимости и повторами.
+    Принимает готовый асинхронный клиент Redis (в т.ч. `fakeredis.aioredis.FakeRedis` для локальных проверок)."""
+
+    def __init__(self, redis, prefix: str = PREFIX, max_attempts: int = MAX_ATTEMPTS):
+        self.redis = redis
+        self.max_attempts = max_attempts
+        self._keys = {k: prefix + k for k in ('pending', 'processing', 'delayed', 'data', 'timeouts', 'dead')}
+        self._claim = redis.register_script(CLAIM_SCRIPT)
+
+    @staticmethod
+    def _score(job: Job) -> float:
+        return job.priority * 1e13 + time.time() * 1000
+
+    async def put(self, job: Job):
+        k = self._keys
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(k['data'], job.id, job.model_dump_json())
+            pipe.hset(k['timeouts'], job.id, job.timeout)
+            pipe.zadd(k['pending'], {job.id: self._score(job)})
+            await pipe.execute()
+        logging.debug(f'JobQueue: Задача поставлена: {job}')
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        raw = await self.redis.hget(self._keys['data'], job_id)
+        return None if raw is None else Job.model_validate_json(raw)
+
+    async def claim(self) -> Optional[Job]:
+        k = self._keys
+        job_id = await self._claim(keys=[k['pending'], k['processing'], k['timeouts']], args=[time.time(), 300])
+        if not job_id:
+            return None
+        job = await self.get(job_id.decode() if isinstance(job_id, bytes) else job_id)
+        if job is None:
+            await self.redis.zrem(k['processing'], job_id)
+        return job
+
+    async def touch(self, job: Job) -> bool:
+        """Продлевает крайний срок выполняемой задачи еще на `job.timeout` сек.; 
+        False, если задача уже не числится за воркером (таймаут истек и ее вернули в очередь)."""
+        return bool(await self.redis.zadd(self._keys['processing'], {job.id: time.time() + job.timeout}, xx=True, ch=True))
+
+    async def ack(self, job: Job):
+        k = self._keys
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(k['processing'], job.id)
+            pipe.hdel(k['data'], job.id)
+            pipe.hdel(k['timeouts'], job.id)
+            await pipe.execute()
+
+    async def nack(self, job: Job, delay: float = 0, count: bool = True) -> bool:
+        """Возвращает задачу в очередь (через `delay` сек.); False, если попытки исчерпаны.
+        С `count=False` попытка не засчитывается (например, воркер просто перегружен)."""
+        k = self._keys
+        if count:
+            job.attempts += 1
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(k['processing'], job.id)
+            if job.attempts >= self.max_attempts:
+                pipe.rpush(k['dead'], job.model_dump_json())
+                pipe.hdel(k['data'], job.id)
+                pipe.hdel(k['timeouts'], job.id)
+            else:
+                pipe.hset(k['data'], job.id, job.model_dump_json())
+                if delay > 0:
+                    pipe.zadd(k['delayed'], {job.id: time.time() + delay})
+                else:
+                    pipe.zadd(k['pending'], {job.id: self._score(job)})
+            await pipe.execute()
+        if job.attempts >= self.max_attempts:
+            logging.warning(f'JobQueue: Попытки исчерпаны: {job}')
+            return False
+        return True
+
+    async def maintain(self):
+        """Возвращает в очередь задачи с истекшим таймаутом (воркер упал или завис) и созревшие отложенные."""
+        k = self._keys
+        now = time.time()
+        for job_id in await self.redis.zrangebyscore(k['processing'], '-inf', now):
+            # ZREM удается только одному из воркеров, так что задача не задвоится
+            if await self.redis.zrem(k['processing'], job_id):
+                job = await self.get(job_id.decode() if isinstance(job_id, bytes) else job_id)
+                if not job is None:
+                    logging.warning(f'JobQueue: Истек таймаут: {job}')
+                    await self.nack(job)
+        for job_id in await self.redis.zrangebyscore(k['delayed'], '-inf', now):
+            if await self.redis.zrem(k['delayed'], job_id):
+                job = await self.get(job_id.decode() if isinstance(job_id, bytes) else job_id)
+                if not job is None:
+                    await self.redis.zadd(k['pending'], {job.id: self._score(job)})
+
+    async def size(self) -> int:
+        return await self.redis.zcard(self._keys['pending'])
@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+import functools
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+try:
+    from prometheus_client import Histogram, Counter, start_http_server, REGISTRY
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+    HAS_PROMETHEUS = True
+except ImportError:
+    HAS_PROMETHEUS = False
+
+#==============================================================================#
+# Метрики Prometheus: длительность и ошибки по этапам обработки, глубина очередей
+# и попадания в кэши. Без `prometheus_client` все вызовы работают вхолостую.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+#==============================================================================#
+
+class _Noop:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def inc(self, *args, **kwargs):
+        pass
+
+if HAS_PROMETHEUS:
+    STAGE_SECONDS = Histogram('imagebot_stage_seconds', 'Длительность этапа обработки', ['stage'], buckets=BUCKETS)
+    STAGE_ERRORS = Counter('imagebot_stage_errors', 'Ошибки на этапе обработки', ['stage'])
+else:
+    STAGE_SECONDS = STAGE_ERRORS = _Noop()
+
+#==============================================================================#
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timer(stage: str):
+    """Замер этапа: `with timer('telegram_download'): ...` (подходит и для кода внутри корутин)."""
+    t = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - t)
+
+def timed(stage: str):
+    """Декоратор замера этапа для обычных функций и корутин."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timer(stage):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#==============================================================================#
+
+_GAUGES: dict[str, tuple[str, Callable[[], float]]] = {}
+_CACHES: dict[str, object] = {}
+_POLLED: dict[str, float] = {}
+
+def track_gauge(name: str, documentation: str, fn: Callable[[], float]):
+    """Значение снимается в момент запроса метрик: `fn` должна быть быстрой и не блокирующей."""
+    _GAUGES[name] = (documentation, fn)
+
+def track_cache(name: str, cache):
+    """Кэш с полями `hits` и `misses`."""
+    _CACHES[name] = cache
+
+async def poll_gauge(name: str, documentation: str, fn: Callable, interval: float = 5.0):
+    """Для асинхронных источников (например, длина очереди в Redis): опрос в фоне, отдается последнее значение."""
+    track_gauge(name, documentation, lambda: _POLLED.get(name, 0))
+    while True:
+        try:
+            _POLLED[name] = await fn()
+        except Exception as err:
+            logging.debug(err, exc_info=False)
+        await asyncio.sleep(interval)
+
+class _Collector:
+
+    def collect(self):
+        for name, (documentation, fn) in list(_GAUGES.items()):
+            try:
+                value = fn()
+            except Exception as err:
+                logging.debug(err, exc_info=False)
+                continue
+            yield GaugeMetricFamily(f'imagebot_{name}', documentation, value=value)
+        hits = CounterMetricFamily('imagebot_cache_hits', 'Попадания в кэш', labels=['cache'])
+        misses = CounterMetricFamily('imagebot_cache_misses', 'Промахи кэша', labels=['cache'])
+        ratio = GaugeMetricFamily('imagebot_cache_hit_ratio', 'Доля попаданий в кэш', labels=['cache'])
+        for name, cache in list(_CACHES.items()):
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            total = cache.hits + cache.misses
+            ratio.add_metric([name], cache.hits / total if total else 0.0)
+        yield hits
+        yield misses
+        yield ratio
+
+_started = False
+
+def start(host: str, port: Optional[int]):
+    """Поднимает HTTP-эндпоинт `/metrics` (в отдельном потоке)."""
+    global _started
+    if _started or not port:
+        return
+    if not HAS_PROMETHEUS:
+        logging.warning('Metrics: prometheus_client не установлен, метрики отключены')
+        return
+    REGISTRY.register(_Collector())
+    start_http_server(port, host)
+    _started = True
+    logging.info(f'Metrics: Эндпоинт запущен на {host}:{port}')
@@ -1,6 +1,9 @@
 import httpx
 import orjson
 import logging
+import importlib.util
+
+from config import CONFIG
 
 #==============================================================================#
 
@@ -8,6 +11,9 @@ ENC = 'utf-8'
 HEADERS = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36', 
            'accept': 'application/json,text/*;q=0.99'}
 PROXIES = None
+HTTP2 = importlib.util.find_spec('h2') is not None
+SECRET_HEADERS = {'authorization', 'x-goog-api-key'}
+SECRET_PARAMS = {'key'}
 
 #==============================================================================#
 
@@ -17,11 +23,17 @@ def serialize(obj) -> str:
 def deserialize(json: str):
     return orjson.loads(json)
 
+def redact(req: httpx.Request) -> dict:
+    # ключи API не должны попадать в лог
+    url = req.url.copy_with(params=[(k, '***' if k in SECRET_PARAMS else v) for k, v in req.url.params.multi_items()])
+    headers = {k: '***' if k.lower() in SECRET_HEADERS else v for k, v in req.headers.items()}
+    return {'url': str(url), 'headers': str(headers)}
+
 async def exec_method(base_url, method_type, method, client=None, headers=HEADERS, params=None, data=None,
                       files=None, proxies=PROXIES, astext=False):
     async def exec_(client_: httpx.AsyncClient):
         req = client_.build_request(method=method_type, url=method, params=params, json=data, files=files)
-        logging.debug(f">>> {serialize({'url': str(req.url), 'headers': str(req.headers), 'data': data})}")
+        logging.debug(f">>> {serialize(redact(req) | {'data': data})}")
         res_obj = None
         res_text = ''
         try:
@@ -38,7 +50,9 @@ async def exec_method(base_url, method_type, method, client=None, headers=HEADER
             logging.exception(str(err) + '\n\n' + res_text, exc_info=False)
         return res_text if astext else res_obj
 
-    if client is None:
+    if client is None and proxies is None:
+        res = await exec_(POOL.get(base_url, headers))
+    elif client is None:
         async with httpx.AsyncClient(headers=headers, base_url=base_url, proxies=proxies, verify=False) as client_:
             res = await exec_(client_)
     else:
@@ -47,16 +61,47 @@ async def exec_method(base_url, method_type, method, client=None, headers=HEADER
 
 #==============================================================================#
 
+class ClientPool:
+    """Долгоживущие HTTP-клиенты (keep-alive, HTTP/2 при наличии `h2`), по одному на базовый URL 
+    с одинаковыми заголовками и настройками: разные вызывающие не навязывают друг другу свои.
+    Лимит соединений `http_max_connections` действует на клиента: для клиентов API (базовый URL - 
+    один хост) это лимит на хост, а общий клиент загрузок картинок (`base_url=''`) ограничен им 
+    суммарно по всем хостам. Закрываются вместе с ботом."""
+
+    def __init__(self):
+        self._clients: dict[tuple, httpx.AsyncClient] = {}
+
+    def get(self, base_url: str = '', headers: dict = HEADERS, **kwargs) -> httpx.AsyncClient:
+        key = (base_url, tuple(sorted((k.lower(), v) for k, v in headers.items())), repr(sorted(kwargs.items())))
+        client = self._clients.get(key, None)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(max_connections=CONFIG.http_max_connections, 
+                                  max_keepalive_connections=CONFIG.http_max_connections, keepalive_expiry=60)
+            params = dict(headers=headers, base_url=base_url, verify=False, http2=HTTP2 and CONFIG.http2, 
+                          limits=limits, timeout=httpx.Timeout(CONFIG.http_timeout), follow_redirects=True) | kwargs
+            client = self._clients[key] = httpx.AsyncClient(**params)
+            logging.debug(f'HTTPX CLIENT INITIALIZED: "{base_url}"')
+        return client
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+        logging.debug('HTTPX CLIENTS FREED')
+
+POOL = ClientPool()
+
+#==============================================================================#
+
 class AsyncRequestor:
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, client: httpx.AsyncClient = None):
         self._base_url = base_url
         self._make_headers()
-        self._client = httpx.AsyncClient(headers=self._headers, base_url=self._base_url, proxies=PROXIES, verify=False)
-        logging.debug('HTTPX CLIENT INITIALIZED')
+        self._client = client or POOL.get(self._base_url, self._headers)
 
     def _make_headers(self):
-        self._headers = HEADERS
+        self._headers = dict(HEADERS)
 
     async def exec_get(self, method, params=None, astext=False):
         return await exec_method(self._base_url, 'GET', method, self._client, params=params, astext=astext)
@@ -68,5 +113,5 @@ class AsyncRequestor:
         return self
 
     async def __aexit__(self, *excinfo):
-        await self._client.aclose()
-        logging.debug('HTTPX CLIENT FREED')
\ No newline at end of file
+        # клиент общий (из пула или передан извне): закрывает его владелец
+        pass
\ No newline at end of file
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# модули бота лежат в корне репозитория
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# настройки бота читаются при импорте `config`: тестам не нужен `.env`, а лог не должен затирать `log.log`
+for key, value in {'BOT_TOKEN': '123456:test', 'BOT_NAME': 'test', 'GOOGLE_CX': 'test', 'GOOGLE_API_KEY': 'test',
+                   'YANDEX_API_KEY': 'test', 'REDIS': 'false', 'REMOTE_WORKERS': 'false',
+                   'LOG_FILE': str(Path(tempfile.gettempdir()) / 'imagebot-test.log')}.items():
+    os.environ.setdefault(key, value)
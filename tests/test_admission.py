@@ -0,0 +1,127 @@
+"""Допуск тяжелых запросов: ведро токенов (на подставных часах) и раздача слотов по кругу."""
+import asyncio
+import pytest
+
+pytest.importorskip('aiogram')
+
+import admission
+from admission import TokenBucket, FairScheduler
+
+# ============================================================ #
+
+class FakeClock:
+    """Подменяет модуль `time` в admission: время идет только вручную."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(admission, 'time', clock)
+    return clock
+
+# ---------------- TokenBucket
+
+def test_bucket_burst(clock: FakeClock):
+    bucket = TokenBucket(burst=3, rate=1)
+    assert [bucket.take(1) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(1) == 1.0
+    assert bucket.take(2) == 2.0
+
+def test_bucket_refill(clock: FakeClock):
+    bucket = TokenBucket(burst=4, rate=2)
+    assert bucket.take(4) == 0
+    clock.now += 0.25
+    assert bucket.take(1) == 0.25
+    clock.now += 0.25
+    assert bucket.take(1) == 0
+    assert not bucket.full
+
+def test_bucket_capped_at_burst(clock: FakeClock):
+    bucket = TokenBucket(burst=2, rate=1)
+    bucket.take(2)
+    clock.now += 100
+    assert bucket.full and bucket.tokens == 2
+    assert bucket.take(2) == 0
+    assert bucket.take(1) == 1.0
+
+# ---------------- FairScheduler
+
+async def settle():
+    # даем проснуться задачам, которым выдан слот
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+async def queue_requests(scheduler: FairScheduler, users: list[int], acquired: list[int], positions: list[int] = None):
+    async def request(uid: int):
+        await scheduler.acquire(uid, notify)
+        acquired.append(uid)
+
+    async def notify(pos: int):
+        if not positions is None:
+            positions.append(pos)
+
+    tasks = []
+    for uid in users:
+        tasks.append(asyncio.create_task(request(uid)))
+        await settle()
+    return tasks
+
+def test_round_robin_across_users():
+    async def test():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire(0)
+        acquired, positions = [], []
+        await queue_requests(scheduler, [1, 1, 2, 3, 1], acquired, positions)
+        # позиция последнего запроса пользователя при раздаче по кругу 1, 2, 3, 1, 1
+        assert positions == [1, 2, 2, 3, 5]
+        assert scheduler.waiting == 5 and scheduler.active == 1
+        for _ in range(5):
+            scheduler.release()
+            await settle()
+        assert acquired == [1, 2, 3, 1, 1]
+        assert scheduler.waiting == 0 and scheduler.active == 1
+    asyncio.run(test())
+
+def test_free_slots_granted_immediately():
+    async def test():
+        scheduler = FairScheduler(2)
+        acquired = []
+        await queue_requests(scheduler, [1, 1, 1], acquired)
+        assert acquired == [1, 1] and scheduler.active == 2 and scheduler.waiting == 1
+        scheduler.release()
+        await settle()
+        assert acquired == [1, 1, 1] and scheduler.active == 2
+    asyncio.run(test())
+
+def test_cancel_while_waiting():
+    async def test():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire(0)
+        acquired = []
+        tasks = await queue_requests(scheduler, [1, 2], acquired)
+        tasks[0].cancel()
+        await settle()
+        assert scheduler.waiting == 1 and scheduler.position(2) == 1
+        scheduler.release()
+        await settle()
+        assert acquired == [2] and scheduler.active == 1
+    asyncio.run(test())
+
+def test_cancel_after_grant_passes_slot():
+    async def test():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire(0)
+        acquired = []
+        tasks = await queue_requests(scheduler, [1, 2], acquired)
+        # слот выдан пользователю 1, но его запрос отменен раньше, чем проснулся
+        scheduler.release()
+        tasks[0].cancel()
+        await settle()
+        assert tasks[0].cancelled()
+        assert acquired == [2] and scheduler.active == 1 and scheduler.waiting == 0
+    asyncio.run(test())
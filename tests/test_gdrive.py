@@ -0,0 +1,54 @@
+"""Обновление токена сервисного аккаунта Google Drive (без обращения к Google)."""
+import datetime
+import pytest
+
+pytest.importorskip('pydrive')
+
+import gdrive
+from gdrive import Gdrive
+
+# ============================================================ #
+
+class FakeServiceCredentials:
+    """Как ServiceAccountCredentials: токен с истечением, но без refresh_token."""
+
+    refresh_token = None
+    invalid = False
+
+    def __init__(self):
+        self.refreshed = 0
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    @property
+    def access_token_expired(self) -> bool:
+        return self.token_expiry <= datetime.datetime.utcnow()
+
+    def refresh(self, http):
+        self.refreshed += 1
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+@pytest.fixture
+def creds(monkeypatch) -> FakeServiceCredentials:
+    creds = FakeServiceCredentials()
+    monkeypatch.setattr(gdrive.ServiceAccountCredentials, 'from_json_keyfile_name', lambda *args: creds)
+    return creds
+
+# ============================================================ #
+
+def test_valid_token_not_refreshed(creds: FakeServiceCredentials):
+    drive = Gdrive()
+    drive.update_creds()
+    drive.update_creds()
+    assert drive._gauth.credentials is creds and creds.refreshed == 0
+
+def test_expired_token_refreshed(creds: FakeServiceCredentials):
+    drive = Gdrive()
+    drive.update_creds()
+    gdrive_client = drive._gdrive
+    creds.token_expiry = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    assert drive._gauth.access_token_expired
+    drive.update_creds()
+    assert creds.refreshed == 1
+    assert not drive._gauth.access_token_expired
+    # клиент Drive и учетные данные те же: ключ заново не читается
+    assert drive._gdrive is gdrive_client and drive._gauth.credentials is creds
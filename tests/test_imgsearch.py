@@ -0,0 +1,44 @@
+"""Кэш выдачи поиска: время жизни записи отсчитывается от ее создания, а не от последней дозаписи."""
+import time
+import asyncio
+import pytest
+
+import imgsearch
+from imgsearch import SearchCache, SearchEntry, SimpleImage
+
+# ============================================================ #
+
+def image(i: int) -> SimpleImage:
+    return SimpleImage(img=b'x' * 10, mime='image/jpeg', filename=f'{i}.jpg')
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch) -> SearchCache:
+    cache = SearchCache(ttl=100, path=str(tmp_path))
+    monkeypatch.setattr(imgsearch, 'SEARCH_CACHE', cache)
+    return cache
+
+# ============================================================ #
+
+def test_set_keeps_expiry(cache: SearchCache):
+    entry = SearchEntry(urls=['u0'], created=time.time() - 90)
+    asyncio.run(cache.set('k', entry))
+    expires = cache.memory._data['k'][0]
+    assert expires - time.monotonic() <= 10
+    assert abs(cache.disk._file('k').stat().st_mtime - entry.created) < 1
+
+def test_set_expired_entry_dropped(cache: SearchCache):
+    asyncio.run(cache.set('k', SearchEntry(urls=['u0'])))
+    asyncio.run(cache.set('k', SearchEntry(urls=['u0'], created=time.time() - 101)))
+    assert cache.memory.get('k') is None
+
+def test_cache_hit_not_rewritten(cache: SearchCache, monkeypatch):
+    # без фильтров ключ кэша зависит только от запроса
+    filters = dict.fromkeys(('fileType', 'safe', 'imgType', 'imgSize', 'imgDominantColor', 'imgColorType'))
+    key = SearchCache.make_key({'q': 'кот', 'searchType': 'image'}, imgsearch.MAX_IMGSIZE)
+    entry = SearchEntry(urls=['u0', 'u1'], images={'u0': image(0), 'u1': image(1)})
+    asyncio.run(cache.set(key, entry))
+    writes = []
+    monkeypatch.setattr(cache, 'set', lambda *args: writes.append(args))
+    found = asyncio.run(imgsearch.search('кот', 2, **filters))
+    assert [res_img.filename for res_img in found] == ['0.jpg', '1.jpg']
+    assert writes == []
@@ -0,0 +1,37 @@
+"""Локальная раздача картинок для Яндекса: тип содержимого соответствует формату картинки."""
+import asyncio
+from io import BytesIO
+import pytest
+
+pytest.importorskip('pydrive')
+
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+from imgsimilar import LocalImageServer
+
+# ============================================================ #
+
+def image(fmt: str) -> bytes:
+    out = BytesIO()
+    Image.new('RGB', (8, 8), 'red').save(out, fmt)
+    return out.getvalue()
+
+@pytest.mark.parametrize('fmt, mime', [('JPEG', 'image/jpeg'), ('PNG', 'image/png'), ('GIF', 'image/gif'), ('WEBP', 'image/webp')])
+def test_served_mime(fmt: str, mime: str):
+    async def test():
+        server = LocalImageServer('127.0.0.1', 0, 'https://bot.example')
+        content = image(fmt)
+        token, url = await server.publish(content)
+        assert url == f'https://bot.example/img/{token}'
+        try:
+            async with TestClient(TestServer(server.make_app())) as client:
+                res = await client.get(f'/img/{token}')
+                assert res.status == 200
+                assert res.content_type == mime
+                assert await res.read() == content
+                server.unpublish(token)
+                assert (await client.get(f'/img/{token}')).status == 404
+        finally:
+            await server.stop()
+    asyncio.run(test())
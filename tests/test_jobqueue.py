@@ -0,0 +1,94 @@
+"""Проверки очереди задач на fakeredis (скрипт взятия задачи требует Lua - пакет `lupa`)."""
+import time
+import asyncio
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+from jobqueue import JobQueue, Job, PRIORITY_HIGH, PRIORITY_LOW
+
+# ============================================================ #
+
+def run(test):
+    async def wrapper():
+        return await test(JobQueue(fakeredis.aioredis.FakeRedis(), max_attempts=2))
+    return lambda: asyncio.run(wrapper())
+
+# ============================================================ #
+
+@run
+async def test_claim_by_priority(queue: JobQueue):
+    low, high = Job(kind='search', chat_id=1, priority=PRIORITY_LOW), Job(kind='caption', chat_id=2, priority=PRIORITY_HIGH)
+    await queue.put(low)
+    await queue.put(high)
+    assert await queue.size() == 2
+    assert (await queue.claim()).id == high.id
+    assert (await queue.claim()).id == low.id
+    assert await queue.claim() is None
+
+@run
+async def test_ack_removes_job(queue: JobQueue):
+    await queue.put(Job(kind='caption', chat_id=1))
+    job = await queue.claim()
+    await queue.ack(job)
+    await queue.maintain()
+    assert await queue.get(job.id) is None
+    assert await queue.claim() is None
+
+@run
+async def test_nack_retries_then_dead_letter(queue: JobQueue):
+    await queue.put(Job(kind='vqa', chat_id=1))
+    job = await queue.claim()
+    assert await queue.nack(job)
+    job = await queue.claim()
+    assert job.attempts == 1
+    assert not await queue.nack(job)
+    assert await queue.claim() is None
+    assert await queue.get(job.id) is None
+    dead = await queue.redis.lrange(queue._keys['dead'], 0, -1)
+    assert [Job.model_validate_json(raw).id for raw in dead] == [job.id]
+
+@run
+async def test_nack_without_count_keeps_attempts(queue: JobQueue):
+    await queue.put(Job(kind='vqa', chat_id=1))
+    for _ in range(3):
+        job = await queue.claim()
+        assert await queue.nack(job, count=False)
+    assert (await queue.claim()).attempts == 0
+
+@run
+async def test_nack_delay(queue: JobQueue):
+    await queue.put(Job(kind='similar', chat_id=1))
+    job = await queue.claim()
+    assert await queue.nack(job, delay=0.2)
+    await queue.maintain()
+    assert await queue.claim() is None
+    await asyncio.sleep(0.3)
+    await queue.maintain()
+    assert (await queue.claim()).id == job.id
+
+@run
+async def test_maintain_requeues_expired(queue: JobQueue):
+    await queue.put(Job(kind='caption', chat_id=1, timeout=0))
+    job = await queue.claim()
+    await asyncio.sleep(0.01)
+    await queue.maintain()
+    again = await queue.claim()
+    assert again.id == job.id and again.attempts == 1
+
+@run
+async def test_touch_extends_deadline(queue: JobQueue):
+    await queue.put(Job(kind='caption', chat_id=1, timeout=1))
+    job = await queue.claim()
+    await asyncio.sleep(0.6)
+    assert await queue.touch(job)
+    await asyncio.sleep(0.6)
+    await queue.maintain()
+    assert await queue.claim() is None
+    deadline = await queue.redis.zscore(queue._keys['processing'], job.id)
+    assert deadline > time.time()
+    await queue.ack(job)
+    # задача уже не числится за воркером: продление не должно вернуть ее в processing
+    assert not await queue.touch(job)
+    assert await queue.redis.zcard(queue._keys['processing']) == 0
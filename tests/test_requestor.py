@@ -0,0 +1,23 @@
+"""Пул HTTP-клиентов: клиент общий только для вызовов с одинаковыми базовым URL, заголовками и настройками."""
+import asyncio
+import httpx
+
+from requestor import ClientPool, HEADERS
+
+# ============================================================ #
+
+def test_same_settings_share_client():
+    pool = ClientPool()
+    assert pool.get('https://a.example') is pool.get('https://a.example', dict(HEADERS))
+    asyncio.run(pool.aclose())
+
+def test_different_settings_get_own_client():
+    pool = ClientPool()
+    base = pool.get('https://a.example')
+    other_headers = pool.get('https://a.example', dict(HEADERS) | {'x-goog-api-key': 'secret'})
+    other_timeout = pool.get('https://a.example', timeout=httpx.Timeout(1.0))
+    assert len({id(base), id(other_headers), id(other_timeout)}) == 3
+    assert other_headers.headers['x-goog-api-key'] == 'secret' and not 'x-goog-api-key' in base.headers
+    assert other_timeout.timeout.read == 1.0
+    asyncio.run(pool.aclose())
+    assert base.is_closed and other_headers.is_closed and other_timeout.is_closed
@@ -0,0 +1,59 @@
+"""Отправка результатов поиска: первые картинки уходят в чат, не дожидаясь самой медленной загрузки."""
+import time
+import asyncio
+import pytest
+
+pytest.importorskip('aiogram')
+pytest.importorskip('pydrive')
+
+import ui
+from imgsearch import SimpleImage
+
+# ============================================================ #
+
+class FakeBot:
+    """Вместо aiogram.Bot: запоминает, когда и сколько картинок отправлено."""
+
+    def __init__(self):
+        self.sent: list[tuple[float, int]] = []
+
+    async def send_media_group(self, chat_id, media):
+        self.sent.append((time.monotonic(), len(media)))
+
+    async def send_photo(self, chat_id, photo):
+        self.sent.append((time.monotonic(), 1))
+
+def fake_search(delays: list[float], downloaded: list[float], fail: bool = False):
+    async def search_iter(q: str, num: int):
+        for i, delay in enumerate(delays):
+            await asyncio.sleep(delay)
+            downloaded.append(time.monotonic())
+            yield SimpleImage(img=b'x', mime='image/jpeg', filename=f'{i}.jpg')
+        if fail:
+            raise RuntimeError('поиск упал')
+    return search_iter
+
+# ============================================================ #
+
+def test_first_album_before_slow_download(monkeypatch):
+    downloaded = []
+    # три картинки готовы сразу, последняя грузится долго
+    monkeypatch.setattr(ui.imgsearch, 'search_iter', fake_search([0, 0, 0, 1.0], downloaded))
+    bot = FakeBot()
+    found = asyncio.run(ui.send_search_results(bot, 1, 'кот', 4))
+    assert found == 4
+    assert [n for _, n in bot.sent] == [3, 1]
+    assert bot.sent[0][0] < downloaded[-1]
+
+def test_full_albums(monkeypatch):
+    monkeypatch.setattr(ui.imgsearch, 'search_iter', fake_search([0] * 23, []))
+    bot = FakeBot()
+    assert asyncio.run(ui.send_search_results(bot, 1, 'кот', 23)) == 23
+    assert [n for _, n in bot.sent] == [10, 10, 3]
+
+def test_search_error_propagates(monkeypatch):
+    monkeypatch.setattr(ui.imgsearch, 'search_iter', fake_search([0, 0], [], fail=True))
+    bot = FakeBot()
+    with pytest.raises(RuntimeError):
+        asyncio.run(ui.send_search_results(bot, 1, 'кот', 2))
+    assert [n for _, n in bot.sent] == [2]
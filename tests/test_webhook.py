@@ -0,0 +1,133 @@
+"""Проверки сервера вебхука на тестовом клиенте aiohttp: секретный токен, порядок обновлений внутри чата,
+отказ при переполнении очереди и дообработка принятых обновлений при остановке."""
+import asyncio
+import pytest
+
+pytest.importorskip('aiogram')
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot
+
+from webhook import WebhookServer, SECRET_HEADER
+
+# ============================================================ #
+
+SECRET = 'test-secret'
+PATH = '/webhook'
+
+class FakeDispatcher:
+    """Вместо aiogram.Dispatcher: запоминает обработанные обновления, обработка длится `delay` сек.
+    (или пока не будет выставлено событие `gate`)."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.gate = None
+        self.release_permit = False
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+
+    async def feed_update(self, bot, update, **kwargs):
+        if self.release_permit:
+            kwargs['update_permit'].release()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if self.gate:
+                await self.gate.wait()
+            await asyncio.sleep(self.delay)
+            self.handled.append((update.message.chat.id, update.update_id))
+        finally:
+            self.running -= 1
+
+def update(update_id: int, chat_id: int) -> dict:
+    return {'update_id': update_id, 
+            'message': {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'тест'}}
+
+def run(test, **kwargs):
+    async def wrapper():
+        dp = FakeDispatcher()
+        server = WebhookServer(dp, Bot('42:TEST'), 'https://example.com', PATH, '127.0.0.1', 0, **({'secret': SECRET} | kwargs))
+        async with TestClient(TestServer(server.make_app())) as client:
+            await test(server, dp, client)
+    return lambda: asyncio.run(wrapper())
+
+async def post(client: TestClient, body: dict, secret: str = SECRET) -> int:
+    res = await client.post(PATH, json=body, headers={SECRET_HEADER: secret} if secret else {})
+    return res.status
+
+async def wait_idle(server: WebhookServer):
+    while server.pending:
+        await asyncio.sleep(0.01)
+
+# ============================================================ #
+
+def test_secret_rejected():
+    async def test(server, dp, client):
+        assert await post(client, update(1, 1), secret=None) == 401
+        assert await post(client, update(2, 1), secret='wrong') == 401
+        assert await post(client, update(3, 1)) == 200
+        await wait_idle(server)
+        assert dp.handled == [(1, 3)]
+    run(test)()
+
+def test_secret_generated():
+    async def test(server, dp, client):
+        assert server._secret
+        assert await post(client, update(1, 1), secret=None) == 401
+        assert await post(client, update(2, 1), secret=server._secret) == 200
+    run(test, secret=None)()
+
+def test_order_within_chat():
+    async def test(server, dp, client):
+        dp.delay = 0.01
+        for i in range(10):
+            assert await post(client, update(i, i % 2)) == 200
+        await wait_idle(server)
+        for chat in (0, 1):
+            assert [u for c, u in dp.handled if c == chat] == list(range(chat, 10, 2))
+        # разные чаты обрабатываются параллельно, один чат - строго по очереди
+        assert dp.max_running == 2
+    run(test)()
+
+def test_released_permit_frees_slot():
+    async def test(server, dp, client):
+        # хэндлер, вернувший слот (ждет тяжелого слота), не блокирует обновления других чатов
+        dp.gate, dp.release_permit = asyncio.Event(), True
+        assert await post(client, update(1, 1)) == 200
+        assert await post(client, update(2, 2)) == 200
+        while dp.running < 2:
+            await asyncio.sleep(0.01)
+        dp.gate.set()
+        await wait_idle(server)
+        assert sorted(dp.handled) == [(1, 1), (2, 2)]
+    run(test, concurrency=1)()
+
+def test_backpressure():
+    async def test(server, dp, client):
+        dp.gate = asyncio.Event()
+        assert await post(client, update(1, 1)) == 200
+        assert await post(client, update(2, 2)) == 200
+        assert await post(client, update(3, 3)) == 429
+        dp.gate.set()
+        await wait_idle(server)
+        assert await post(client, update(4, 3)) == 200
+    run(test, max_pending=2)()
+
+def test_stop_drains_accepted_updates():
+    async def test(server, dp, client):
+        dp.delay = 0.05
+        for i in range(4):
+            assert await post(client, update(i, 1)) == 200
+        await server.stop()
+        assert [u for _, u in dp.handled] == list(range(4))
+        assert await post(client, update(5, 1)) == 503
+    run(test)()
+
+def test_stop_timeout_cancels():
+    async def test(server, dp, client):
+        dp.gate = asyncio.Event()
+        assert await post(client, update(1, 1)) == 200
+        await server.stop()
+        assert dp.handled == [] and server.pending == 0
+    run(test, drain_timeout=0.05)()
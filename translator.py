@@ -1,35 +1,188 @@
+import httpx
+import asyncio
 import logging
-from typing import Union
+import threading
+from abc import ABC, abstractmethod
+from typing import Union, Optional
+from concurrent.futures import ThreadPoolExecutor
 
 from config import CONFIG
 from requestor import AsyncRequestor
+from cache import Cache
+from metrics import timer, timed
 
 #==============================================================================#
 
 BASE_URL = 'https://translate.api.cloud.yandex.net/translate/v2'
+MAX_BATCH_CHARS = 9000      # API принимает до 10000 символов за запрос
+MARIAN_MODEL = 'Helsinki-NLP/opus-mt-{}-{}'
+
+# переводы по (исходный язык, целевой язык, текст)
+CACHE = Cache('translations', CONFIG.translate_cache_size, CONFIG.translate_cache_ttl)
 
 #==============================================================================#
 
-class Translator(AsyncRequestor):
+class TranslationBatcher:
+    """Объединяет одновременные переводы из разных чатов в один запрос `texts=[...]`
+    (отдельно для каждого движка и пары языков)."""
 
-    def __init__(self):
-        super().__init__(BASE_URL)
+    def __init__(self, window: float = 0.05):
+        self._window = window
+        self._pending: dict[tuple, dict[str, list[asyncio.Future]]] = {}
+        self._tasks = set()
 
-    def _make_headers(self):
-        super()._make_headers()
-        self._headers |= {'Authorization': f'Api-Key {CONFIG.yandex_api_key.get_secret_value()}'}
+    async def submit(self, translator: 'BaseTranslator', text: str, tolang: str, fromlang: Optional[str]) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        langs = (translator.name, fromlang, tolang)
+        if not langs in self._pending:
+            self._pending[langs] = {}
+            loop.call_later(self._window, self._flush, translator, langs)
+        # одинаковые строки из разных чатов переводим один раз
+        self._pending[langs].setdefault(text, []).append(future)
+        return await future
+
+    def _flush(self, translator: 'BaseTranslator', langs: tuple):
+        pending = self._pending.pop(langs, {})
+        batch, size = {}, 0
+        for text, futures in pending.items():
+            if batch and size + len(text) > MAX_BATCH_CHARS:
+                self._run(translator, langs, batch)
+                batch, size = {}, 0
+            batch[text] = futures
+            size += len(text)
+        if batch:
+            self._run(translator, langs, batch)
+
+    def _run(self, translator: 'BaseTranslator', langs: tuple, batch: dict[str, list[asyncio.Future]]):
+        task = asyncio.create_task(self._request(translator, langs, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _request(self, translator: 'BaseTranslator', langs: tuple, batch: dict[str, list[asyncio.Future]]):
+        texts = list(batch)
+        _, fromlang, tolang = langs
+        logging.debug(f'Translator: Пакет из {len(texts)} строк ({fromlang} -> {tolang}) ...')
+        try:
+            with timer(f'translate_request_{translator.name}'):
+                results = await translator.request(texts, tolang, fromlang)
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+            results = []
+        if len(results) != len(texts):
+            results = [None] * len(texts)
+        for futures, result in zip(batch.values(), results):
+            for future in futures:
+                if not future.done(): future.set_result(result)
+
+BATCHER = TranslationBatcher(CONFIG.translate_batch_window)
+
+#==============================================================================#
 
+class BaseTranslator(ABC):
+    """Движок перевода: наследники реализуют `request`, а кэш и объединение запросов общие."""
+
+    name = 'base'
+
+    @abstractmethod
+    async def request(self, texts: list[str], tolang='ru', fromlang=None) -> list[str]:
+        ...
+
+    @timed('translate')
     async def translate(self, texts: Union[str, list[str]], tolang='ru', fromlang=None) -> list[str]:
         if isinstance(texts, str):
             texts = [texts]
+        tolang = tolang.lower()
+        fromlang = fromlang.lower() if fromlang else None
+        keys = [f'{self.name}:{fromlang or ""}:{tolang}:{text}' for text in texts]
+        results = [await CACHE.get(key) if text.strip() else text for key, text in zip(keys, texts)]
+
+        missing = list({text: key for text, key, res in zip(texts, keys, results) if res is None}.items())
+        if missing:
+            translated = await asyncio.gather(*[BATCHER.submit(self, text, tolang, fromlang) for text, _ in missing])
+            found = {}
+            for (text, key), res in zip(missing, translated):
+                if res is None: continue
+                found[text] = res
+                await CACHE.set(key, res)
+            results = [found.get(text, None) if res is None else res for text, res in zip(texts, results)]
+
+        if None in results:
+            logging.debug(f'Translator: Нет вариантов перевода')
+            return []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excinfo):
+        pass
+
+#==============================================================================#
+
+class Translator(AsyncRequestor, BaseTranslator):
+    """Yandex Translate API."""
+
+    name = 'yandex'
+
+    def __init__(self, client: httpx.AsyncClient = None):
+        super().__init__(BASE_URL, client)
+
+    def _make_headers(self):
+        super()._make_headers()
+        self._headers |= {'Authorization': f'Api-Key {CONFIG.yandex_api_key.get_secret_value()}'}
+
+    async def request(self, texts: list[str], tolang='ru', fromlang=None) -> list[str]:
         payload = dict(texts=texts, targetLanguageCode=tolang.lower())
         if fromlang:
             payload['sourceLanguageCode'] = fromlang.lower()
 
         res = await self.exec_post('/translate', data=payload)
-        if res is None or not res.get('translations', None): 
+        if res is None or not res.get('translations', None):
             logging.debug(f'Translator: Нет вариантов перевода')
             return []
-        
+
         return [element.get('text', '') for element in res['translations']]
-        
+
+#==============================================================================#
+
+class MarianTranslator(BaseTranslator):
+    """Локальный перевод на CPU моделями MarianMT (Helsinki-NLP/opus-mt-*).
+    Модели загружаются один раз на процесс; с `marian_local_only` берутся только из локального кэша HF."""
+
+    name = 'marian'
+    _models: dict[tuple, tuple] = {}
+    _lock = threading.Lock()
+    _executor = ThreadPoolExecutor(1, thread_name_prefix='marian')
+
+    @classmethod
+    def load(cls, fromlang: str, tolang: str) -> tuple:
+        from transformers import MarianMTModel, MarianTokenizer
+        with cls._lock:
+            if not (fromlang, tolang) in cls._models:
+                name = MARIAN_MODEL.format(fromlang, tolang)
+                logging.info(f'MarianTranslator: Загрузка модели {name} ...')
+                tokenizer = MarianTokenizer.from_pretrained(name, local_files_only=CONFIG.marian_local_only)
+                model = MarianMTModel.from_pretrained(name, local_files_only=CONFIG.marian_local_only).eval()
+                cls._models[(fromlang, tolang)] = (tokenizer, model)
+            return cls._models[(fromlang, tolang)]
+
+    @classmethod
+    def _translate(cls, texts: list[str], tolang: str, fromlang: str) -> list[str]:
+        import torch
+        tokenizer, model = cls.load(fromlang, tolang)
+        with torch.inference_mode():
+            batch = tokenizer(texts, return_tensors='pt', padding=True, truncation=True)
+            output = model.generate(**batch)
+        return tokenizer.batch_decode(output, skip_special_tokens=True)
+
+    async def request(self, texts: list[str], tolang='ru', fromlang=None) -> list[str]:
+        tolang = tolang.lower()
+        # язык оригинала не определяем: бот переводит только между русским и английским
+        fromlang = (fromlang or ('en' if tolang == 'ru' else 'ru')).lower()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._translate, texts, tolang, fromlang)
+
+#==============================================================================#
+
+def get_translator() -> BaseTranslator:
+    return MarianTranslator() if CONFIG.translator == 'marian' else Translator()
@@ -0,0 +1,116 @@
+import logging
+import asyncio
+from aiogram import Bot
+from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
+from aiogram.types import (ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton,
+                           BufferedInputFile, InputMediaPhoto)
+from aiogram.exceptions import TelegramRetryAfter
+
+import imgsearch
+from imgsimilar import SimilarResult
+from metrics import timer
+
+# ============================================================ #
+# общие для бота и удаленных воркеров клавиатуры и отправка ответов
+
+BTNS_IMG_ACTIONS = ['✍ Описание', '❓ Вопрос', '👥 Похожие', '❌ Отмена']
+NL = '\n'
+ALBUM_SIZE = 10      # максимум фото в одном sendMediaGroup
+ALBUM_WAIT = 0.2     # сек. ожидания следующей картинки, прежде чем отправить неполный альбом
+SEND_ATTEMPTS = 3
+BUSY_REPLY = '🚦 Сейчас слишком много запросов, попробуй чуть позже'
+MORE_REPLY = '❓ Еще что-то?                                         ❓'
+
+# ============================================================ #
+
+def make_keyboard(items: list[str], placeholder: str = 'Выберите действие', cols: int = 3) -> ReplyKeyboardMarkup:
+    builder = ReplyKeyboardBuilder()
+    builder.add(*[KeyboardButton(text=item) for item in items])
+    builder.adjust(min(cols, len(items)))
+    return builder.as_markup(resize_keyboard=True, input_field_placeholder=placeholder or None)
+
+def make_keyboard_inline(items: list[dict], cols: int = 3) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.add(*[InlineKeyboardButton(**item) for item in items])
+    builder.adjust(min(cols, len(items)))
+    return builder.as_markup(resize_keyboard=True)
+
+def actions_keyboard() -> InlineKeyboardMarkup:
+    return make_keyboard_inline([{'text': s, 'callback_data': s} for s in BTNS_IMG_ACTIONS], 3)
+
+def similar_reply(result: SimilarResult) -> str:
+    sreply = ''
+    if result.title and result.subtitle:
+        sreply += f'{result.title} - {result.subtitle}{NL}'
+    if result.tags:
+        sreply += '🟢 ' + f'{NL}🟢 '.join(result.tags) + NL
+    if result.similar:
+        sreply += f'Найдено {len(result.similar)} похожих изображений'
+    return sreply
+
+# ============================================================ #
+
+async def send_with_retry(method, *args, **kwargs):
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            with timer(f'telegram_{method.__name__}'):
+                return await method(*args, **kwargs)
+        except TelegramRetryAfter as err:
+            if attempt == SEND_ATTEMPTS - 1: raise
+            logging.warning(f'Флуд-контроль Telegram: повтор через {err.retry_after} сек.')
+            await asyncio.sleep(err.retry_after)
+
+async def send_album(bot: Bot, chat_id: int, images: list[imgsearch.SimpleImage]):
+    if len(images) > 1:
+        try:
+            await send_with_retry(bot.send_media_group, chat_id,
+                                  [InputMediaPhoto(media=BufferedInputFile(res.img, res.filename)) for res in images])
+            return
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+    # альбом не прошел (или в нем одна картинка): шлем по одной, пропуская сбойные
+    for res in images:
+        try:
+            await send_with_retry(bot.send_photo, chat_id, BufferedInputFile(res.img, res.filename))
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+
+async def send_search_results(bot: Bot, chat_id: int, q: str, num: int) -> int:
+    """Ищет картинки и шлет их альбомами по мере готовности; возвращает число найденных.
+    Альбом уходит, как только следующая картинка не готова в течение `ALBUM_WAIT` сек.: 
+    пользователь видит первые результаты, не дожидаясь самой медленной загрузки."""
+    results = asyncio.Queue()
+
+    async def produce():
+        # загрузки продолжаются, пока отправляется очередной альбом
+        try:
+            async for res in imgsearch.search_iter(q=q, num=num):
+                results.put_nowait(res)
+        finally:
+            results.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    found = 0
+    album = []
+    try:
+        while True:
+            try:
+                res = await (asyncio.wait_for(results.get(), ALBUM_WAIT) if album else results.get())
+            except asyncio.TimeoutError:
+                await send_album(bot, chat_id, album)
+                album = []
+                continue
+            if res is None:
+                break
+            found += 1
+            album.append(res)
+            if len(album) == ALBUM_SIZE:
+                await send_album(bot, chat_id, album)
+                album = []
+        if album:
+            await send_album(bot, chat_id, album)
+        # ошибка поиска доходит до вызывающего, как и раньше
+        await producer
+    finally:
+        producer.cancel()
+    return found
@@ -0,0 +1,187 @@
+import hmac
+import signal
+import asyncio
+import logging
+import secrets
+from typing import Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+#==============================================================================#
+# Режим вебхука: Telegram сам присылает обновления POST-запросами на сервер бота.
+# Обновления обрабатываются параллельно (не более `concurrency` одновременно),
+# но в пределах одного чата строго по очереди - долгая обработка картинки у одного
+# пользователя не задерживает остальных и не перемешивает его собственные сообщения.
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+#==============================================================================#
+
+def chat_key(update: Update) -> int:
+    """Ключ очереди для обновления: чат (или пользователь), иначе само обновление."""
+    try:
+        event = update.event
+    except Exception:
+        return -update.update_id
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if not chat is None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user else -update.update_id
+
+class UpdatePermit:
+    """Слот обработки одного обновления. Передается в данные хэндлеров (`update_permit`): хэндлер,
+    который надолго встает в ожидание (например, тяжелого слота в AdmissionMiddleware), возвращает его 
+    раньше, чтобы ожидающие не занимали слоты обновлений других чатов."""
+
+    def __init__(self, slots: asyncio.Semaphore):
+        self._slots = slots
+        self._held = False
+
+    async def acquire(self):
+        await self._slots.acquire()
+        self._held = True
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self._slots.release()
+
+class UpdateScheduler:
+    """Параллельная обработка обновлений с сохранением порядка внутри чата."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, concurrency: int, max_pending: int):
+        self._dp = dp
+        self._bot = bot
+        self._slots = asyncio.Semaphore(concurrency)
+        self._max_pending = max_pending
+        self._chats: dict[int, asyncio.Queue] = {}
+        self._tasks = set()
+        self.pending = 0
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self._max_pending
+
+    def put(self, update: Update):
+        key = chat_key(update)
+        self.pending += 1
+        queue = self._chats.get(key, None)
+        if queue is None:
+            # первый апдейт чата: заводим очередь и ее обработчика (живет, пока в очереди что-то есть)
+            queue = self._chats[key] = asyncio.Queue()
+            task = asyncio.create_task(self._drain(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.put_nowait(update)
+
+    async def _drain(self, key: int, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                permit = UpdatePermit(self._slots)
+                try:
+                    await permit.acquire()
+                    await self._dp.feed_update(self._bot, update, update_permit=permit)
+                except Exception as err:
+                    logging.exception(err, exc_info=True)
+                finally:
+                    permit.release()
+                    self.pending -= 1
+        finally:
+            self._chats.pop(key, None)
+
+    async def stop(self, timeout: float = 30):
+        # принятые обновления Telegram повторно не пришлет: сначала даем их обработать, и лишь по таймауту отменяем
+        tasks = list(self._tasks)
+        if not tasks:
+            return
+        logging.info(f'UpdateScheduler: Ожидание обработки {self.pending} обновлений ...')
+        _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+        if unfinished:
+            logging.warning(f'UpdateScheduler: Не обработано за {timeout} сек.: {self.pending} обновлений')
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+#==============================================================================#
+
+class WebhookServer:
+    """aiohttp-сервер вебхука с проверкой секретного токена. Если токен не задан, он генерируется
+    при запуске (Telegram получает его вместе с адресом вебхука)."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, url: str, path: str, host: str, port: int,
+                 secret: Optional[str] = None, concurrency: int = 16, max_pending: int = 1000, drain_timeout: float = 30):
+        self._dp = dp
+        self._bot = bot
+        self._url = url.rstrip('/') + path
+        self._path = path
+        self._host = host
+        self._port = port
+        self._secret = secret or secrets.token_urlsafe(32)
+        self._drain_timeout = drain_timeout
+        self._scheduler = UpdateScheduler(dp, bot, concurrency, max_pending)
+        self._runner: Optional[web.AppRunner] = None
+        self._closing = False
+
+    @property
+    def pending(self) -> int:
+        return self._scheduler.pending
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self._secret):
+            raise web.HTTPUnauthorized()
+        if self._closing:
+            # бот останавливается: обновление не принимаем, Telegram доставит его после перезапуска
+            raise web.HTTPServiceUnavailable()
+        if self._scheduler.full:
+            # Telegram повторит доставку позже, ничего не теряется
+            logging.warning(f'WebhookServer: Очередь переполнена ({self._scheduler.pending}), обновление отклонено')
+            raise web.HTTPTooManyRequests()
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self._bot})
+        except Exception as err:
+            logging.debug(err, exc_info=True)
+            raise web.HTTPBadRequest()
+        # отвечаем сразу, обработка идет в фоне
+        self._scheduler.put(update)
+        return web.Response()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self._path, self._handle)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        await self._bot.set_webhook(self._url, secret_token=self._secret,
+                                    allowed_updates=self._dp.resolve_used_update_types())
+        logging.info(f'WebhookServer: Запущен на {self._host}:{self._port}, вебхук {self._url}')
+
+    async def stop(self):
+        # сначала перестаем принимать обновления, затем дорабатываем уже принятые
+        self._closing = True
+        if not self._runner is None:
+            await self._runner.cleanup()
+            self._runner = None
+        await self._scheduler.stop(self._drain_timeout)
+
+    async def run(self):
+        await self._dp.emit_startup(bot=self._bot)
+        await self.start()
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: остановка только по Ctrl+C (KeyboardInterrupt)
+                pass
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop()
+            await self._dp.emit_shutdown(bot=self._bot)
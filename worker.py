@@ -0,0 +1,154 @@
+import logging
+import asyncio
+from aiogram import Bot
+from redis.asyncio import Redis
+
+from config import CONFIG
+from requestor import POOL
+from jobqueue import JobQueue, Job
+from ui import BUSY_REPLY, MORE_REPLY, actions_keyboard, make_keyboard_inline, similar_reply, send_search_results
+import imgcap
+import imgsearch
+import imgsimilar
+import translator
+import metrics
+
+# ============================================================ #
+# Удаленный воркер: забирает из очереди Redis тяжелые задачи бота (описание, вопрос, похожие, поиск)
+# и сам отправляет ответы в чат. Воркеры не хранят состояния, их можно запускать сколько угодно на любых узлах.
+
+POLL_INTERVAL = 0.5         # сек. ожидания, когда очередь пуста
+MAINTAIN_INTERVAL = 5.0     # сек. между проверками зависших и отложенных задач
+BUSY_DELAY = 5.0            # сек. до повтора задачи, если пул инференса переполнен
+
+# ============================================================ #
+
+async def run_caption(bot: Bot, job: Job):
+    p = job.payload
+    summary = await imgcap.Imgcap.cached_summary(p.get('uid'), p['number'])
+    if not summary:
+        with metrics.timer('telegram_download'):
+            pic = await bot.download(p['file_id'])
+        imcap = await imgcap.Imgcap.open(pic, p.get('uid'))
+        summary = await imcap.summary(p['number'])
+    await bot.send_message(job.chat_id, '. '.join(summary) if summary else '🤔 Описание не найдено')
+    await bot.send_message(job.chat_id, MORE_REPLY, reply_markup=actions_keyboard())
+
+async def run_vqa(bot: Bot, job: Job):
+    p = job.payload
+    answer = await imgcap.Imgcap.cached_answer(p.get('uid'), p['question'], p.get('lang'))
+    if answer is None:
+        with metrics.timer('telegram_download'):
+            pic = await bot.download(p['file_id'])
+        imcap = await imgcap.Imgcap.open(pic, p.get('uid'))
+        answer = await imcap.answer(p['question'], p.get('lang'))
+    await bot.send_message(job.chat_id, answer or '🤔 Ответ не найден')
+    await bot.send_message(job.chat_id, MORE_REPLY, reply_markup=actions_keyboard())
+
+async def run_similar(bot: Bot, job: Job):
+    with metrics.timer('telegram_download'):
+        pic = await bot.download(job.payload['file_id'])
+    result = await imgsimilar.Imgsimilar().upload_and_parse(pic.getvalue())
+    await bot.send_message(job.chat_id, similar_reply(result),
+                           reply_markup=make_keyboard_inline([{'text': '🔺 Открыть ссылку', 'url': result.url}], 1))
+    await bot.send_message(job.chat_id, MORE_REPLY, reply_markup=actions_keyboard())
+
+async def run_search(bot: Bot, job: Job):
+    found = await send_search_results(bot, job.chat_id, job.payload['q'], job.payload['num'])
+    if not found:
+        await bot.send_message(job.chat_id, '🤔 Картинки не найдены')
+
+HANDLERS = {'caption': run_caption, 'vqa': run_vqa, 'similar': run_similar, 'search': run_search}
+ERRORS = {'caption': '⛔ Ошибка загрузки картинки, попробуй загрузить заново',
+          'vqa': '⛔ Ошибка загрузки картинки, попробуй загрузить заново',
+          'similar': '⛔ Ошибка при поиске похожих картинок',
+          'search': '⛔ Ошибка при поиске картинок'}
+
+# ============================================================ #
+
+async def heartbeat(queue: JobQueue, job: Job):
+    # пока задача выполняется, продлеваем ее таймаут видимости, чтобы другой воркер ее не забрал
+    while True:
+        await asyncio.sleep(job.timeout / 3)
+        try:
+            if not await queue.touch(job):
+                logging.warning(f'Worker: Задача {job} уже возвращена в очередь')
+                return
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+
+async def process(bot: Bot, queue: JobQueue, job: Job):
+    logging.info(f'Worker: Выполнение задачи {job} ...')
+    alive = asyncio.create_task(heartbeat(queue, job))
+    try:
+        await HANDLERS[job.kind](bot, job)
+    except imgcap.InferenceBusyError as err:
+        logging.warning(err)
+        await queue.nack(job, BUSY_DELAY, count=False)
+    except Exception as err:
+        logging.exception(err, exc_info=True)
+        if not await queue.nack(job):
+            await bot.send_message(job.chat_id, ERRORS.get(job.kind, BUSY_REPLY))
+    else:
+        await queue.ack(job)
+        logging.info(f'Worker: Задача {job} выполнена')
+    finally:
+        alive.cancel()
+
+async def maintain(queue: JobQueue):
+    while True:
+        try:
+            await queue.maintain()
+        except Exception as err:
+            logging.exception(err, exc_info=False)
+        await asyncio.sleep(MAINTAIN_INTERVAL)
+
+async def main():
+    redis = Redis.from_url(CONFIG.redis_url)
+    imgcap.RESULTS.redis = redis
+    translator.CACHE.redis = redis
+    imgsimilar.CACHE.redis = redis
+    queue = JobQueue(redis)
+    bot = Bot(token=CONFIG.bot_token.get_secret_value())
+    if CONFIG.preload_models and CONFIG.inference_pool != 'process':
+        imgcap.MODELS.preload()
+    imgcap.INFERENCE.start()
+    metrics.track_gauge('inference_pending', 'Задачи в пуле инференса (выполняются и ждут)', lambda: imgcap.INFERENCE.pending)
+    metrics.track_cache('results', imgcap.RESULTS)
+    metrics.track_cache('translations', translator.CACHE)
+    metrics.track_cache('similar', imgsimilar.CACHE)
+    metrics.track_cache('search', imgsearch.SEARCH_CACHE)
+    metrics.start(CONFIG.metrics_host, CONFIG.metrics_port)
+
+    slots = asyncio.Semaphore(CONFIG.worker_concurrency)
+    tasks = {asyncio.create_task(maintain(queue)),
+             asyncio.create_task(metrics.poll_gauge('jobs_pending', 'Задачи в очереди удаленных воркеров', queue.size))}
+    logging.info(f'Worker: Запущен (параллельных задач: {CONFIG.worker_concurrency})')
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                job = await queue.claim()
+            except Exception as err:
+                logging.exception(err, exc_info=False)
+                job = None
+            if job is None:
+                slots.release()
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(process(bot, queue, job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        for task in tasks:
+            task.cancel()
+        imgcap.INFERENCE.shutdown()
+        await imgsimilar.LOCAL_SERVER.stop()
+        await imgsimilar.DRIVE.stop()
+        await POOL.aclose()
+        await bot.session.close()
+        await redis.aclose()
+
+if __name__ == '__main__':
+    asyncio.run(main())